@@ -0,0 +1,241 @@
+"""
+Inverse of encoders.py: turns feature matrices (from FigmaNodesDataset.__getitem__, a sharded export or a generative model)
+back into design trees of node dicts.
+
+The encoders store categories as indices (not one-hot), so categorical features decode by rounding to the nearest
+index (out of range -> None), booleans by thresholding at 0.5 and hex8 colors by scaling back to bytes.
+Everything is decoded column-wise over all the nodes of a batch at once; only the final dicts are built in Python.
+"""
+
+import json
+import numpy as np
+from data_processing.encoders import (
+    NODE_CHANNELS, NODE_FEATURES, NODE_COLUMNS, feature_position, decode_hex8_column,
+    TYPE_CATEGORIES, EXPORT_SETTINGS_CATEGORIES, FONT_WEIGHT_CATEGORIES, FONT_FAMILY_CATEGORIES, FONT_STYLE_CATEGORIES,
+    TEXT_ALIGN_CATEGORIES, TEXT_ALIGN_VERTICAL_CATEGORIES, TEXT_DECORATION_CATEGORIES, TEXT_AUTO_RESIZE_CATEGORIES,
+    BORDER_ALIGNMENT_CATEGORIES, CONSTRAINT_VERTICAL_CATEGORIES, CONSTRAINT_HORIZONTAL_CATEGORIES,
+    LAYOUT_ALIGN_CATEGORIES, LAYOUT_MODE_CATEGORIES, LAYOUT_POSITIONING_CATEGORIES, LAYOUT_GROW_CATEGORIES,
+    PRIMARY_AXIS_SIZING_MODE_CATEGORIES, COUNTER_AXIS_SIZING_MODE_CATEGORIES,
+    PRIMARY_AXIS_ALIGN_ITEMS_CATEGORIES, COUNTER_AXIS_ALIGN_ITEMS_CATEGORIES,
+)
+
+# categorical columns and the categories their index refers to
+# (type and font_family decode to the generic category, the original value is not recoverable)
+CATEGORIES = {
+    'type': TYPE_CATEGORIES,
+    'export_settings': EXPORT_SETTINGS_CATEGORIES,
+    'font_weight': FONT_WEIGHT_CATEGORIES,
+    'font_family': FONT_FAMILY_CATEGORIES,
+    'font_style': FONT_STYLE_CATEGORIES,
+    'text_align': TEXT_ALIGN_CATEGORIES,
+    'text_align_vertical': TEXT_ALIGN_VERTICAL_CATEGORIES,
+    'text_decoration': TEXT_DECORATION_CATEGORIES,
+    'text_auto_resize': TEXT_AUTO_RESIZE_CATEGORIES,
+    'border_alignment': BORDER_ALIGNMENT_CATEGORIES,
+    'constraint_vertical': CONSTRAINT_VERTICAL_CATEGORIES,
+    'constraint_horizontal': CONSTRAINT_HORIZONTAL_CATEGORIES,
+    'layout_align': LAYOUT_ALIGN_CATEGORIES,
+    'layout_mode': LAYOUT_MODE_CATEGORIES,
+    'layout_positioning': LAYOUT_POSITIONING_CATEGORIES,
+    'layout_grow': LAYOUT_GROW_CATEGORIES,
+    'primary_axis_sizing_mode': PRIMARY_AXIS_SIZING_MODE_CATEGORIES,
+    'counter_axis_sizing_mode': COUNTER_AXIS_SIZING_MODE_CATEGORIES,
+    'primary_axis_align_items': PRIMARY_AXIS_ALIGN_ITEMS_CATEGORIES,
+    'counter_axis_align_items': COUNTER_AXIS_ALIGN_ITEMS_CATEGORIES,
+}
+BOOLEAN_COLUMNS = {'background_image', 'reverse', 'is_mask'}
+INTEGER_COLUMNS = {'depth', 'n_children', 'n_characters'}
+COLOR_COLUMNS = {name for channel in NODE_CHANNELS for name, encoder, _ in channel if encoder is decode_hex8_column}
+
+# feature position of every column (a column encoded twice, like opacity, decodes from its first position)
+POSITIONS = {name: feature_position(name) for name in NODE_COLUMNS}
+DEPTH = POSITIONS['depth']
+
+
+def decode_category_column(values, categories):
+    index = np.rint(values).astype(np.int64)
+    valid = (index >= 0) & (index < len(categories))
+    table = np.array(list(categories) + [None], dtype=object)
+    return table[np.where(valid, index, len(categories))].tolist()
+
+
+def encode_hex8_column(rgba):
+    """
+    (n, 4) RGBA in 0-1 range -> '#rrggbbaa' strings (None for all zeros, which is how None is encoded).
+    """
+    raw = np.rint(np.clip(rgba, 0, 1) * 255).astype(np.uint8)
+    hex8 = raw.tobytes().hex()
+    colors = ["#" + hex8[i:i + 8] for i in range(0, len(hex8), 8)]
+    for i in np.flatnonzero(~raw.any(axis=1)).tolist():
+        colors[i] = None
+    return colors
+
+
+def decode_columns(nodes):
+    """
+    Decode an (n, len(NODE_CHANNELS), NODE_FEATURES) array into {column: list of n values}.
+    """
+    columns = {}
+    for name in NODE_COLUMNS:
+        c, f = POSITIONS[name]
+        if name in COLOR_COLUMNS:
+            columns[name] = encode_hex8_column(nodes[:, c, f:f + 4])
+            continue
+        values = nodes[:, c, f]
+        if name in CATEGORIES:
+            columns[name] = decode_category_column(values, CATEGORIES[name])
+        elif name in BOOLEAN_COLUMNS:
+            columns[name] = (values >= 0.5).tolist()
+        elif name in INTEGER_COLUMNS:
+            columns[name] = np.rint(values).astype(np.int64).tolist()
+        else:
+            values = values.astype(np.float64)
+            finite = np.isfinite(values)
+            # NaN / inf (e.g. from a diverged model) decode to None, they are not valid JSON
+            columns[name] = values.tolist() if finite.all() else np.where(finite, values, None).tolist()
+    return columns
+
+
+def json_column(name, values):
+    """
+    JSON text of each value of a decoded column (what `json.dumps` would write for it).
+    """
+    if name in CATEGORIES or name in BOOLEAN_COLUMNS or name in COLOR_COLUMNS:
+        table = {value: json.dumps(value) for value in set(values)}
+        return list(map(table.__getitem__, values))
+    if name in INTEGER_COLUMNS:
+        return list(map(str, values))
+    # floats (None for non-finite values)
+    return [repr(value) if value is not None else "null" for value in values] if None in values else list(map(repr, values))
+
+
+def parents(depths, lengths):
+    """
+    Parent index of every node of consecutive depth-first (pre-order) node lists, from the node depths
+    (-1 for each list's root). `lengths` is the number of nodes of each list; the returned indices are global.
+    Depths are made consistent first: every node after a root is at least one level below it,
+    and at most one level below the node before it (a deeper jump attaches to the previous node).
+    """
+    depths = np.asarray(depths, dtype=np.int64)
+    n = len(depths)
+    starts = np.cumsum(lengths) - lengths
+    is_root = np.zeros(n, dtype=bool)
+    is_root[starts[lengths > 0]] = True
+
+    # depth relative to the root of each list: 0 for the roots, >= 1 below
+    relative = depths - np.repeat(depths[starts[lengths > 0]], lengths[lengths > 0])
+    relative = np.where(is_root, 0, np.maximum(relative, 1))
+    # depth[i] <= depth[i - 1] + 1  <=>  depth[i] - i <= depth[i - 1] - (i - 1);
+    # a root (0 - i) is always below the running minimum, so lists never constrain each other
+    steps = np.arange(n)
+    relative = np.minimum.accumulate(relative - steps) + steps
+
+    parent = np.full(n, -1, dtype=np.int64)
+    for depth in np.unique(relative[~is_root]).tolist():
+        # the parent is the last node one level up before the node, which is always in the same list
+        above = np.flatnonzero(relative == depth - 1)
+        nodes = np.flatnonzero(relative == depth)
+        parent[nodes] = above[np.searchsorted(above, nodes) - 1]
+    return parent
+
+
+def children_counts(parent):
+    return np.bincount(parent[parent >= 0], minlength=len(parent))
+
+
+def build_trees(columns, parent):
+    """
+    Build node dicts from decoded `columns`, nest them under their parents as "children" lists
+    and return the roots (parent -1), in order. `n_children` is set to the number of children in the rebuilt tree.
+    """
+    columns["n_children"] = children_counts(parent).tolist()
+    children = [[] for _ in range(len(parent))]
+    keys = list(columns) + ["children"]
+    rows = [dict(zip(keys, values)) for values in zip(*columns.values(), children)]
+
+    # nodes are in pre-order, so appending in index order keeps the sibling order
+    for row, p in zip(rows, parent.tolist()):
+        if p >= 0:
+            children[p].append(row)
+    return [row for row, p in zip(rows, parent.tolist()) if p < 0]
+
+
+def build_json_trees(columns, parent):
+    """
+    Same trees as `build_trees`, serialized straight to compact JSON text (one string per root)
+    without building the dicts: each node is a formatted template, children are joined bottom-up.
+    """
+    columns["n_children"] = children_counts(parent).tolist()
+    template = "{" + ",".join(f"{json.dumps(name)}:%s" for name in columns) + ',"children":['
+    heads = [template % values for values in zip(*(json_column(name, values) for name, values in columns.items()))]
+
+    parent = parent.tolist()
+    children = [[] for _ in parent]
+    # reverse pre-order: every node is complete before its parent is
+    for i in range(len(parent) - 1, -1, -1):
+        text = heads[i] + ",".join(reversed(children[i])) + "]}"
+        if parent[i] >= 0:
+            children[parent[i]].append(text)
+        else:
+            heads[i] = text
+    return [heads[i] for i, p in enumerate(parent) if p < 0]
+
+
+def decode_batch(features, lengths=None):
+    """
+    The real nodes of a batch of encoded designs, decoded column-wise, with their parent indices and the node count of each design.
+    features: (batch, n_nodes * len(NODE_CHANNELS), NODE_FEATURES) or (batch, n_nodes, len(NODE_CHANNELS), NODE_FEATURES),
+    or a single sample without the batch axis.
+    lengths: number of real nodes per sample; by default trailing all-zero nodes (padding) are dropped.
+    """
+    features = np.asarray(features, dtype=np.float32)
+    if features.ndim == 2 or (features.ndim == 3 and features.shape[1:] == (len(NODE_CHANNELS), NODE_FEATURES)):
+        features = features[None]
+    batch = features.reshape(features.shape[0], -1, len(NODE_CHANNELS), NODE_FEATURES)
+
+    if lengths is None:
+        nonzero = batch.reshape(batch.shape[0], batch.shape[1], -1).any(axis=2)
+        # last non-zero node + 1
+        lengths = np.where(nonzero.any(axis=1), batch.shape[1] - np.argmax(nonzero[:, ::-1], axis=1), 0)
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    # decode the real nodes of the whole batch in one go
+    nodes = batch[np.arange(batch.shape[1])[None, :] < lengths[:, None]]
+    parent = parents(np.rint(nodes[:, DEPTH[0], DEPTH[1]]), lengths)
+    return decode_columns(nodes), parent, lengths
+
+
+def decode_designs(features, lengths=None):
+    """
+    Decode a batch of encoded designs (see `decode_batch`) into design trees (nested node dicts), one per sample.
+    Samples without any node decode to None.
+    """
+    columns, parent, lengths = decode_batch(features, lengths)
+    roots = iter(build_trees(columns, parent))
+    return [next(roots) if length else None for length in lengths.tolist()]
+
+
+def decode_jsonl(features, lengths=None):
+    """
+    Like `decode_designs`, but each design comes out as one line of compact JSON (the fast path for `write_jsonl`).
+    """
+    columns, parent, lengths = decode_batch(features, lengths)
+    roots = iter(build_json_trees(columns, parent))
+    return [next(roots) if length else "null" for length in lengths.tolist()]
+
+
+def write_jsonl(designs, file):
+    """
+    Stream design trees to `file` (a path or an open text file), one JSON document per line.
+    `designs` can be any iterable of design dicts or of JSON lines from `decode_jsonl`
+    (e.g. a generator over successive batches).
+    """
+    if isinstance(file, (str, bytes)) or hasattr(file, "__fspath__"):
+        with open(file, "w") as f:
+            return write_jsonl(designs, f)
+    count = 0
+    for design in designs:
+        file.write(design if isinstance(design, str) else json.dumps(design, separators=(",", ":")))
+        file.write("\n")
+        count += 1
+    return count
@@ -1,5 +1,6 @@
 import json
 import os
+from operator import itemgetter
 from pathlib import Path
 import numpy as np
 
@@ -9,51 +10,83 @@ __dir__ = Path(os.path.dirname(os.path.abspath(__file__)))
 font_fallbacks_map: dict = json.load(Path(__dir__ / 'font-fallbacks-map.json').open())
 
 
+# bump whenever an encoder or NODE_CHANNELS changes, so incremental exports re-encode everything
+ENCODER_VERSION = 1
+
+
+def build_index(categories):
+    """
+    Precompute a value -> index lookup table for a categories list.
+    Duplicates keep their first index, same as `categories.index`.
+    """
+    index = {}
+    for i, value in enumerate(categories):
+        index.setdefault(value, i)
+    return index
+
+
+def encode_lookup(value, index):
+    """
+    Encode a value by its precomputed index (see `build_index`), -1 if unknown.
+    """
+    try:
+        return index.get(value, -1)
+    except TypeError:
+        # unhashable values (e.g. the list entries of font-fallbacks-map.json) are never in a categories list
+        return -1
+
+
 def encode_r(r):
     if r is None:
         return 0
     return r
     
 
+TYPE_MAPPING = {
+    'FRAME': 'CONTAINER',
+    'GROUP': 'CONTAINER',
+    'INSTANCE': 'CONTAINER',
+    'COMPONENT': 'CONTAINER',
+    'RECTANGLE': 'SHAPE',
+    'ELLIPSE': 'SHAPE',
+    'POLYGON': 'SHAPE',
+    'LINE': 'SHAPE',
+    'VECTOR': 'SHAPE',
+    'STAR': 'SHAPE',
+    'BOOLEAN_OPERATION': 'SHAPE',
+    'TEXT': 'TEXT',
+}
+# changing the order of the categories will break the model
+TYPE_CATEGORIES = ['OTHER', 'CONTAINER', 'SHAPE', 'TEXT']
+TYPE_INDEX = build_index(TYPE_CATEGORIES)
+
 def encode_type(_type):
     """
     Encode a type into a one-hot vector
     """
-    mapping = {
-        'FRAME': 'CONTAINER',
-        'GROUP': 'CONTAINER',
-        'INSTANCE': 'CONTAINER',
-        'COMPONENT': 'CONTAINER',
-        'RECTANGLE': 'SHAPE',
-        'ELLIPSE': 'SHAPE',
-        'POLYGON': 'SHAPE',
-        'LINE': 'SHAPE',
-        'VECTOR': 'SHAPE',
-        'STAR': 'SHAPE',
-        'BOOLEAN_OPERATION': 'SHAPE',
-        'TEXT': 'TEXT',
-    }
-    # changing the order of the categories will break the model
-    categories = ['OTHER', 'CONTAINER', 'SHAPE', 'TEXT']
-    return encode_index(mapping.get(_type, 'OTHER'), categories)
+    return encode_lookup(TYPE_MAPPING.get(_type, 'OTHER'), TYPE_INDEX)
+
 
+EXPORT_SETTINGS_MAPPING = {
+    "PNG": "BITMAP",
+    "JPG": "BITMAP",
+    "SVG": "VECTOR",
+    "PDF": "VECTOR",
+}
+# changing the order of the categories will break the model
+EXPORT_SETTINGS_CATEGORIES = [None, 'BITMAP', 'VECTOR']
+EXPORT_SETTINGS_INDEX = build_index(EXPORT_SETTINGS_CATEGORIES)
 
 def encode_export_settings(export_settings):
     """
     Encode export settings into a one-hot vector
     """
-    mapping = {
-        "PNG": "BITMAP",
-        "JPG": "BITMAP",
-        "SVG": "VECTOR",
-        "PDF": "VECTOR",
-    }
-
-    # changing the order of the categories will break the model
-    categories = [None, 'BITMAP', 'VECTOR']
+    return encode_lookup(EXPORT_SETTINGS_MAPPING.get(export_settings), EXPORT_SETTINGS_INDEX)
 
-    return encode_index(mapping.get(export_settings), categories)
 
+# changing the order of the categories will break the model
+FONT_WEIGHT_CATEGORIES = [None, '100', '200', '300', '400', '500', '600', '700', '800', '900']
+FONT_WEIGHT_INDEX = build_index(FONT_WEIGHT_CATEGORIES)
 
 def encode_font_weight(font_weight):
     """
@@ -63,10 +96,27 @@ def encode_font_weight(font_weight):
     # sometimes the font weight is 950, which is not in the list, so we need to round it.
     font_weight = str(round(int(font_weight if font_weight else 0) / 100) * 100)
 
-    # changing the order of the categories will break the model
-    categories = [None, '100', '200', '300', '400', '500', '600', '700', '800', '900']
-    return encode_index(font_weight, categories)
-
+    return encode_lookup(font_weight, FONT_WEIGHT_INDEX)
+
+
+# changing the order of the categories will break the model
+FONT_FAMILY_CATEGORIES = [
+    None,
+    "serif",
+    "sans-serif",
+    "monospace",
+    "cursive",
+    "fantasy",
+    "system-ui",
+    "ui-serif",
+    "ui-sans-serif",
+    "ui-monospace",
+    "ui-rounded",
+    "emoji",
+    "math",
+    "fangsong",
+]
+FONT_FAMILY_INDEX = build_index(FONT_FAMILY_CATEGORIES)
 
 def encode_font_family(font_family):
     """
@@ -77,117 +127,131 @@ def encode_font_family(font_family):
     # fallback to sans-serif if font family is not found (in google fonts)
     generic = font_fallbacks_map.get(font_family, "sans-serif")
 
-    # changing the order of the categories will break the model
-    categories = [
-        None,
-        "serif",
-        "sans-serif",
-        "monospace",
-        "cursive",
-        "fantasy",
-        "system-ui",
-        "ui-serif",
-        "ui-sans-serif",
-        "ui-monospace",
-        "ui-rounded",
-        "emoji",
-        "math",
-        "fangsong",
-    ]
-    
-    return encode_index(generic, categories)
+    return encode_lookup(generic, FONT_FAMILY_INDEX)
+
 
+# changing the order of the categories will break the model
+FONT_STYLE_CATEGORIES = [None, 'normal', 'italic']
+FONT_STYLE_INDEX = build_index(FONT_STYLE_CATEGORIES)
 
 def encode_font_style(font_style):
-    # changing the order of the categories will break the model
-    categories = [None, 'normal', 'italic']
-    return encode_index(font_style, categories)
+    return encode_lookup(font_style, FONT_STYLE_INDEX)
+
+# changing the order of the categories will break the model
+TEXT_ALIGN_CATEGORIES = [None, 'LEFT', 'RIGHT', 'CENTER', 'JUSTIFIED']
+TEXT_ALIGN_INDEX = build_index(TEXT_ALIGN_CATEGORIES)
 
 def encode_text_align(text_align):
-    # changing the order of the categories will break the model
-    categories = [None, 'LEFT', 'RIGHT', 'CENTER', 'JUSTIFIED']
-    return encode_index(text_align, categories)
+    return encode_lookup(text_align, TEXT_ALIGN_INDEX)
+
+# changing the order of the categories will break the model
+TEXT_ALIGN_VERTICAL_CATEGORIES = [None, 'TOP', 'CENTER', 'BOTTOM']
+TEXT_ALIGN_VERTICAL_INDEX = build_index(TEXT_ALIGN_VERTICAL_CATEGORIES)
 
 def encode_text_align_vertical(text_align_vertical):
-    # changing the order of the categories will break the model
-    categories = [None, 'TOP', 'CENTER', 'BOTTOM']
-    return encode_index(text_align_vertical, categories)
+    return encode_lookup(text_align_vertical, TEXT_ALIGN_VERTICAL_INDEX)
+
+# changing the order of the categories will break the model
+TEXT_DECORATION_CATEGORIES = [None, 'UNDERLINE', 'STRIKETHROUGH']
+TEXT_DECORATION_INDEX = build_index(TEXT_DECORATION_CATEGORIES)
 
 def encode_text_decoration(text_decoration):
-    # changing the order of the categories will break the model
-    categories = [None, 'UNDERLINE', 'STRIKETHROUGH']
-    return encode_index(text_decoration, categories)
+    return encode_lookup(text_decoration, TEXT_DECORATION_INDEX)
+
+# changing the order of the categories will break the model
+TEXT_AUTO_RESIZE_CATEGORIES = [None, 'HEIGHT', 'WIDTH_AND_HEIGHT', 'TRUNCATE']
+TEXT_AUTO_RESIZE_INDEX = build_index(TEXT_AUTO_RESIZE_CATEGORIES)
 
 def encode_text_auto_resize(text_auto_resize):
-    # changing the order of the categories will break the model
-    categories = [None, 'HEIGHT', 'WIDTH_AND_HEIGHT', 'TRUNCATE']
-    return encode_index(text_auto_resize, categories)
+    return encode_lookup(text_auto_resize, TEXT_AUTO_RESIZE_INDEX)
+
 
+# strokeAlign
+# changing the order of the categories will break the model
+BORDER_ALIGNMENT_CATEGORIES = [None, 'INSIDE', 'CENTER', 'OUTSIDE']
+BORDER_ALIGNMENT_INDEX = build_index(BORDER_ALIGNMENT_CATEGORIES)
 
 def encode_border_alignment(border_alignment):
-    # strokeAlign
-    # changing the order of the categories will break the model
-    categories = [None, 'INSIDE', 'CENTER', 'OUTSIDE']
-    return encode_index(border_alignment, categories)
+    return encode_lookup(border_alignment, BORDER_ALIGNMENT_INDEX)
+
 
+# https://www.figma.com/developers/api#layoutconstraint-type
+# changing the order of the categories will break the model
+CONSTRAINT_VERTICAL_CATEGORIES = [None, 'TOP', 'BOTTOM', 'CENTER', 'TOP_BOTTOM', 'SCALE']
+CONSTRAINT_VERTICAL_INDEX = build_index(CONSTRAINT_VERTICAL_CATEGORIES)
 
 def encode_constraint_vertical(constraint_vertical):
-    # https://www.figma.com/developers/api#layoutconstraint-type
-    # changing the order of the categories will break the model
-    categories = [None, 'TOP', 'BOTTOM', 'CENTER', 'TOP_BOTTOM', 'SCALE']
-    return encode_index(constraint_vertical, categories)
+    return encode_lookup(constraint_vertical, CONSTRAINT_VERTICAL_INDEX)
+
+# https://www.figma.com/developers/api#layoutconstraint-type
+# changing the order of the categories will break the model
+CONSTRAINT_HORIZONTAL_CATEGORIES = [None, 'LEFT', 'RIGHT', 'CENTER', 'LEFT_RIGHT', 'SCALE']
+CONSTRAINT_HORIZONTAL_INDEX = build_index(CONSTRAINT_HORIZONTAL_CATEGORIES)
 
 def encode_constraint_horizontal(constraint_horizontal):
-    # https://www.figma.com/developers/api#layoutconstraint-type
-    # changing the order of the categories will break the model
-    categories = [None, 'LEFT', 'RIGHT', 'CENTER', 'LEFT_RIGHT', 'SCALE']
-    return encode_index(constraint_horizontal, categories)
+    return encode_lookup(constraint_horizontal, CONSTRAINT_HORIZONTAL_INDEX)
+
+# changing the order of the categories will break the model
+LAYOUT_ALIGN_CATEGORIES = [
+    None, 
+    # current
+    'INHERIT', 'STRETCH',
+    # legacy
+    'MIN', 'MAX', 'CENTER', 'STRETCH'
+]
+LAYOUT_ALIGN_INDEX = build_index(LAYOUT_ALIGN_CATEGORIES)
 
 def encode_layout_align(layout_align):
-    # changing the order of the categories will break the model
-    categories = [
-        None, 
-        # current
-        'INHERIT', 'STRETCH',
-        # legacy
-        'MIN', 'MAX', 'CENTER', 'STRETCH'
-    ]
-    return encode_index(layout_align, categories)
+    return encode_lookup(layout_align, LAYOUT_ALIGN_INDEX)
+
+# changing the order of the categories will break the model
+LAYOUT_MODE_CATEGORIES = [None, 'NONE', 'HORIZONTAL', 'VERTICAL']
+LAYOUT_MODE_INDEX = build_index(LAYOUT_MODE_CATEGORIES)
 
 def encode_layout_mode(layout_mode):
-    # changing the order of the categories will break the model
-    categories = [None, 'NONE', 'HORIZONTAL', 'VERTICAL']
-    return encode_index(layout_mode, categories)
+    return encode_lookup(layout_mode, LAYOUT_MODE_INDEX)
+
+# changing the order of the categories will break the model
+LAYOUT_POSITIONING_CATEGORIES = [None, 'AUTO', 'ABSOLUTE']
+LAYOUT_POSITIONING_INDEX = build_index(LAYOUT_POSITIONING_CATEGORIES)
 
 def encode_layout_positioning(layout_positioning):
-    # changing the order of the categories will break the model
-    categories = [None, 'AUTO', 'ABSOLUTE']
-    return encode_index(layout_positioning, categories)
+    return encode_lookup(layout_positioning, LAYOUT_POSITIONING_INDEX)
+
+# changing the order of the categories will break the model
+LAYOUT_GROW_CATEGORIES = [None, 0, 1]
+LAYOUT_GROW_INDEX = build_index(LAYOUT_GROW_CATEGORIES)
 
 def encode_layout_grow(layout_grow):
-    # changing the order of the categories will break the model
-    categories = [None, 0, 1]
-    return encode_index(layout_grow, categories)
+    return encode_lookup(layout_grow, LAYOUT_GROW_INDEX)
+
+# changing the order of the categories will break the model
+PRIMARY_AXIS_SIZING_MODE_CATEGORIES = [None, 'FIXED', 'AUTO']
+PRIMARY_AXIS_SIZING_MODE_INDEX = build_index(PRIMARY_AXIS_SIZING_MODE_CATEGORIES)
 
 def encode_primary_axis_sizing_mode(primary_axis_sizing_mode):
-    # changing the order of the categories will break the model
-    categories = [None, 'FIXED', 'AUTO']
-    return encode_index(primary_axis_sizing_mode, categories)
+    return encode_lookup(primary_axis_sizing_mode, PRIMARY_AXIS_SIZING_MODE_INDEX)
+
+# changing the order of the categories will break the model
+COUNTER_AXIS_SIZING_MODE_CATEGORIES = [None, 'FIXED', 'AUTO']
+COUNTER_AXIS_SIZING_MODE_INDEX = build_index(COUNTER_AXIS_SIZING_MODE_CATEGORIES)
 
 def encode_counter_axis_sizing_mode(counter_axis_sizing_mode):
-    # changing the order of the categories will break the model
-    categories = [None, 'FIXED', 'AUTO']
-    return encode_index(counter_axis_sizing_mode, categories)
+    return encode_lookup(counter_axis_sizing_mode, COUNTER_AXIS_SIZING_MODE_INDEX)
+
+# changing the order of the categories will break the model
+PRIMARY_AXIS_ALIGN_ITEMS_CATEGORIES = [None, 'MIN', 'CENTER', 'MAX', 'SPACE_BETWEEN']
+PRIMARY_AXIS_ALIGN_ITEMS_INDEX = build_index(PRIMARY_AXIS_ALIGN_ITEMS_CATEGORIES)
 
 def encode_primary_axis_align_items(primary_axis_align_items):
-    # changing the order of the categories will break the model
-    categories = [None, 'MIN', 'CENTER', 'MAX', 'SPACE_BETWEEN']
-    return encode_index(primary_axis_align_items, categories)
+    return encode_lookup(primary_axis_align_items, PRIMARY_AXIS_ALIGN_ITEMS_INDEX)
+
+# changing the order of the categories will break the model
+COUNTER_AXIS_ALIGN_ITEMS_CATEGORIES = [None, 'MIN', 'CENTER', 'MAX', 'BASELINE']
+COUNTER_AXIS_ALIGN_ITEMS_INDEX = build_index(COUNTER_AXIS_ALIGN_ITEMS_CATEGORIES)
 
 def encode_counter_axis_align_items(counter_axis_align_items):
-    # changing the order of the categories will break the model
-    categories = [None, 'MIN', 'CENTER', 'MAX', 'BASELINE']
-    return encode_index(counter_axis_align_items, categories)
+    return encode_lookup(counter_axis_align_items, COUNTER_AXIS_ALIGN_ITEMS_INDEX)
 
 
 def encode_onehot(value, categories):
@@ -257,4 +321,187 @@ def encode_tobinary(value, null=0):
     return null
 
 def is_not_empty(s: str):
-    return s and s.strip()
\ No newline at end of file
+    return s and s.strip()
+
+# -- columnar (batch) encoders --
+# These take whole columns instead of single values and return NumPy arrays.
+# Categorical columns go through the same scalar encoders above (once per distinct value),
+# so the indices are always identical to the per-node path.
+
+def as_column(values):
+    """
+    Accept a list, NumPy array or Arrow (chunked) array and return a Python list.
+    """
+    if hasattr(values, "to_pylist"):
+        return values.to_pylist()
+    if isinstance(values, np.ndarray):
+        return values.tolist()
+    return list(values)
+
+
+def map_unique(encoder, values):
+    """
+    Apply a scalar encoder once per distinct value of a column.
+    Values are keyed by type as well, so 1, 1.0 and True are encoded separately (as the scalar encoders do).
+    """
+    if len(set(map(type, values)) & {bool, int, float}) > 1:
+        keys = list(zip(map(type, values), values))
+        table = {key: encoder(key[1]) for key in dict.fromkeys(keys)}
+    else:
+        # no mixed numeric types, the values themselves are unambiguous keys
+        keys = values
+        table = {key: encoder(key) for key in dict.fromkeys(keys)}
+    return np.fromiter(map(table.__getitem__, keys), dtype=np.float64, count=len(keys))
+
+
+def encode_r_column(values):
+    # NULL -> 0 (sqlite has no NaN, so NaN only ever comes from None here)
+    column = np.array(values, dtype=np.float64)
+    column[np.isnan(column)] = 0
+    return column
+
+
+def decode_hex8_column(values):
+    """
+    Decode a column of hex8 colors into an (n, 4) RGBA array, in 0-1 range
+    """
+    rgba = np.zeros((len(values), 4), dtype=np.float64)
+    fast = [i for i, v in enumerate(values) if v is not None and len(v) == 9]
+    try:
+        # '#RRGGBBAA' -> 4 bytes each, parsed in one go
+        raw = bytes.fromhex("".join(values[i][1:] for i in fast))
+        rgba[fast] = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 4) / 255
+    except ValueError:
+        fast = []
+
+    # anything else goes through the scalar decoder (which raises on malformed values, as before)
+    done = set(fast)
+    for i, v in enumerate(values):
+        if v is not None and i not in done:
+            rgba[i] = decode_hex8(v)
+    return rgba
+
+
+def categorical(encoder):
+    return lambda values: map_unique(encoder, values)
+
+
+# (column, column encoder, default when the key is missing) for each channel,
+# in feature order (changing it will break the model)
+NODE_CHANNELS = [
+    [('type', categorical(encode_type), None)],
+    [
+        ('x', encode_r_column, None), ('y', encode_r_column, None),
+        ('width', encode_r_column, None), ('height', encode_r_column, None),
+        ('depth', encode_r_column, None),
+        ('n_children', encode_r_column, None),
+        ('rotation', encode_r_column, 0),
+    ],
+    [('opacity', encode_r_column, None), ('background_image', categorical(encode_tobinary), None)],
+    [('background_color', decode_hex8_column, None)],
+    [
+        ('border_alignment', categorical(encode_border_alignment), None),
+        ('border_width', encode_r_column, None),
+        ('border_radius', encode_r_column, None),
+    ],
+    [('border_color', decode_hex8_column, None)],
+    [
+        ('opacity', encode_r_column, 1),
+        ('n_characters', encode_r_column, 0),
+        ('font_family', categorical(encode_font_family), None),
+        ('font_weight', categorical(encode_font_weight), None),
+        ('font_size', encode_r_column, None),
+        ('font_style', categorical(encode_font_style), None),
+        ('text_decoration', categorical(encode_text_decoration), None),
+        ('text_align', categorical(encode_text_align), None),
+        ('text_align_vertical', categorical(encode_text_align_vertical), None),
+        ('text_auto_resize', categorical(encode_text_auto_resize), None),
+        ('letter_spacing', encode_r_column, None),
+    ],
+    [('color', decode_hex8_column, None)],
+    [
+        ('constraint_vertical', categorical(encode_constraint_vertical), None),
+        ('constraint_horizontal', categorical(encode_constraint_horizontal), None),
+    ],
+    [
+        ('layout_align', categorical(encode_layout_align), None),
+        ('layout_mode', categorical(encode_layout_mode), None),
+        ('layout_positioning', categorical(encode_layout_positioning), None),
+        ('layout_grow', categorical(encode_layout_grow), None),
+        ('primary_axis_sizing_mode', categorical(encode_primary_axis_sizing_mode), None),
+        ('counter_axis_sizing_mode', categorical(encode_counter_axis_sizing_mode), None),
+        ('primary_axis_align_items', categorical(encode_primary_axis_align_items), None),
+        ('counter_axis_align_items', categorical(encode_counter_axis_align_items), None),
+        ('reverse', categorical(encode_is_boolean), None),
+    ],
+    [
+        ('padding_top', encode_r_column, None),
+        ('padding_left', encode_r_column, None),
+        ('padding_right', encode_r_column, None),
+        ('padding_bottom', encode_r_column, None),
+    ],
+    [('gap', encode_r_column, None)],
+    [
+        ('box_shadow_offset_x', encode_r_column, None),
+        ('box_shadow_offset_y', encode_r_column, None),
+        ('box_shadow_blur', encode_r_column, None),
+        ('box_shadow_spread', encode_r_column, None),
+    ],
+    [('aspect_ratio', encode_r_column, None)],
+    [('is_mask', categorical(encode_is_boolean), None)],
+    [('export_settings', categorical(encode_export_settings), None)],
+]
+
+# hex8 columns expand to 4 features
+NODE_FEATURES = max(
+    sum(4 if encoder is decode_hex8_column else 1 for _, encoder, _ in channel)
+    for channel in NODE_CHANNELS
+)
+
+# every column the features are computed from
+NODE_COLUMNS = list(dict.fromkeys(name for channel in NODE_CHANNELS for name, _, _ in channel))
+
+
+def feature_position(name):
+    """
+    (channel, feature) of the first feature encoded from column `name`.
+    """
+    for c, channel in enumerate(NODE_CHANNELS):
+        f = 0
+        for column, encoder, _ in channel:
+            if column == name:
+                return c, f
+            f += 4 if encoder is decode_hex8_column else 1
+    raise KeyError(name)
+
+
+def encode_nodes(nodes):
+    """
+    Encode a batch of nodes into a dense float32 array of shape (n_nodes, len(NODE_CHANNELS), NODE_FEATURES).
+    `nodes` is either a list of row dicts or a dict of columns (lists, NumPy or Arrow arrays).
+    Reshaping the result to (-1, NODE_FEATURES) gives the same matrix as the per-node path.
+    """
+    if isinstance(nodes, dict):
+        n = len(next(iter(nodes.values()))) if nodes else 0
+        get_column = lambda name, default: as_column(nodes[name]) if name in nodes else [default] * n
+    else:
+        n = len(nodes)
+        try:
+            # rows straight from the db have every column: transpose them in one pass
+            columns = dict(zip(NODE_COLUMNS, zip(*map(itemgetter(*NODE_COLUMNS), nodes)))) if n else {}
+            get_column = lambda name, default: list(columns[name]) if n else []
+        except KeyError:
+            get_column = lambda name, default: [node.get(name, default) for node in nodes]
+
+    matrix = np.zeros((n, len(NODE_CHANNELS), NODE_FEATURES), dtype=np.float32)
+    for c, channel in enumerate(NODE_CHANNELS):
+        f = 0
+        for name, encoder, default in channel:
+            column = encoder(get_column(name, default))
+            if column.ndim == 1:
+                matrix[:, c, f] = column
+                f += 1
+            else:
+                matrix[:, c, f:f + column.shape[1]] = column
+                f += column.shape[1]
+    return matrix
@@ -0,0 +1,88 @@
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups samples of similar length, so a batch padded to its own longest sample
+    carries little padding. Works with any collate function that pads per batch
+    (vaegen `custom_collate`, seq2seq `pad_collate`); pass it as `DataLoader(batch_sampler=...)`.
+
+    Every epoch the indices are shuffled, cut into buckets of `batch_size * bucket_size` samples,
+    each bucket is sorted by length and split into batches, and the batches are shuffled across buckets.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=100, shuffle=True, drop_last=False, seed=0):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        n = len(self.lengths)
+        indices = torch.randperm(n, generator=generator) if self.shuffle else torch.arange(n)
+
+        batches = []
+        bucket = self.batch_size * self.bucket_size
+        for start in range(0, n, bucket):
+            chunk = indices[start:start + bucket]
+            # stable sort, so equal lengths keep their shuffled order
+            chunk = chunk[torch.sort(self.lengths[chunk], stable=True).indices]
+            batches.extend(chunk[i:i + self.batch_size].tolist() for i in range(0, len(chunk), self.batch_size))
+
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        # a new order every epoch, without having to call set_epoch
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        n = len(self.lengths)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+
+def padding_ratio(lengths, batches):
+    """
+    Fraction of padded positions when each batch is padded to its own longest sample.
+    """
+    lengths = torch.as_tensor(lengths)
+    padded = total = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        total += int(batch_lengths.max()) * len(batch)
+        padded += int(batch_lengths.max()) * len(batch) - int(batch_lengths.sum())
+    return padded / total if total else 0.0
+
+
+def padding_report(lengths, batch_size, sampler):
+    """
+    Padding ratio of padding to the global max length, of random batches padded per batch,
+    and of the bucketed batches from `sampler`.
+    """
+    lengths = torch.as_tensor(lengths)
+    n = len(lengths)
+    global_ratio = 1 - int(lengths.sum()) / (int(lengths.max()) * n) if n else 0.0
+
+    shuffled = torch.randperm(n).tolist()
+    random_batches = [shuffled[i:i + batch_size] for i in range(0, n, batch_size)]
+
+    return (
+        f"Padding: {global_ratio:.1%} padded to global max, "
+        f"{padding_ratio(lengths, random_batches):.1%} random batches, "
+        f"{padding_ratio(lengths, sampler.batches()):.1%} bucketed batches"
+    )
@@ -0,0 +1,235 @@
+"""
+Sharded on-disk format for exported samples (see FigmaNodesDataset.save_shards).
+
+<dir>/manifest.json
+<dir>/shard-00000.values.npy   float32 (rows, features)  node rows of every sample in the shard, concatenated
+<dir>/shard-00000.offsets.npy  int64 (count + 1,)        sample i is values[offsets[i]:offsets[i + 1]]
+<dir>/shard-00000.types.npy    int64 (count,)            encoded root type
+<dir>/shard-00000.dims.npy     float64 (count, 2)        root width, height
+<dir>/shard-00000.hashes.npy   uint8 (count, 16)         content hash of each sample's subtree (see FigmaNodesDataset.content_hash)
+
+Shard k always holds samples [k * shard_size, (k + 1) * shard_size), so shards can be written
+in any order (and skipped when already complete) without changing the final sample order.
+The hashes let a later export reuse unchanged samples, or whole unchanged shards, from a previous one.
+"""
+
+import os
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 2
+ARRAYS = ("values", "offsets", "types", "dims", "hashes")
+
+
+def shard_name(k):
+    return f"shard-{k:05d}"
+
+
+def hashes_array(hashes):
+    # 16-byte digests as uint8 rows (a bytes dtype would drop trailing zero bytes)
+    return np.frombuffer(b"".join(hashes), dtype=np.uint8).reshape(-1, 16)
+
+
+def write_json(path, data):
+    # write to a temp file first so a crash never leaves a truncated manifest
+    tmp = Path(f"{path}.tmp")
+    with tmp.open("w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+class ShardWriter:
+    def __init__(self, path, num_samples, shard_size, num_features, meta=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.path / MANIFEST
+
+        config = {
+            "version": FORMAT_VERSION,
+            "num_samples": num_samples,
+            "shard_size": shard_size,
+            "num_features": num_features,
+            "meta": meta or {},
+        }
+
+        if self.manifest_path.exists():
+            with self.manifest_path.open() as f:
+                manifest = json.load(f)
+            previous = {key: manifest.get(key) for key in config}
+            if previous != config:
+                raise ValueError(
+                    f"{self.path} holds an export with a different configuration ({previous}), use another output directory")
+            self.manifest = manifest
+        else:
+            self.manifest = {**config, "shards": {}}
+            write_json(self.manifest_path, self.manifest)
+
+    @property
+    def num_shards(self):
+        return -(-self.manifest["num_samples"] // self.manifest["shard_size"])
+
+    def shard_range(self, k):
+        start = k * self.manifest["shard_size"]
+        return start, min(start + self.manifest["shard_size"], self.manifest["num_samples"])
+
+    def pending(self):
+        """
+        Shards that are not written yet (all of them on a fresh export).
+        """
+        return [k for k in range(self.num_shards) if shard_name(k) not in self.manifest["shards"]]
+
+    @property
+    def complete(self):
+        return not self.pending()
+
+    def write_shard(self, k, samples, hashes):
+        """
+        Write shard `k` from a list of (features, root_type, (width, height)) and their content hashes,
+        and record it in the manifest.
+        """
+        entry = self.write_arrays(k, samples, hashes)
+        self.commit(k, entry)
+        return entry
+
+    def write_arrays(self, k, samples, hashes):
+        """
+        Write the shard files only; `commit` records them. Split so a parent process can own the manifest.
+        """
+        start, stop = self.shard_range(k)
+        if len(samples) != stop - start or len(hashes) != stop - start:
+            raise ValueError(f"shard {k} expects {stop - start} samples, got {len(samples)}")
+
+        lengths = [len(features) for features, _, _ in samples]
+        offsets = np.zeros(len(samples) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        values = np.empty((offsets[-1], self.manifest["num_features"]), dtype=np.float32)
+        for i, (features, _, _) in enumerate(samples):
+            values[offsets[i]:offsets[i + 1]] = np.asarray(features, dtype=np.float32)
+
+        arrays = {
+            "values": values,
+            "offsets": offsets,
+            "types": np.array([root_type[0] for _, root_type, _ in samples], dtype=np.int64),
+            "dims": np.array([dims for _, _, dims in samples], dtype=np.float64).reshape(-1, 2),
+            "hashes": hashes_array(hashes),
+        }
+
+        name = shard_name(k)
+        for key, array in arrays.items():
+            tmp = self.path / f"{name}.{key}.tmp.npy"
+            np.save(tmp, array)
+            os.replace(tmp, self.path / f"{name}.{key}.npy")
+
+        return {"start": start, "count": stop - start, "rows": int(offsets[-1])}
+
+    def link_shard(self, k, source, source_name):
+        """
+        Reuse an identical shard of a previous export (`source`, a ShardReader) as shard `k`:
+        the files are hard-linked (copied when linking is not possible) instead of re-encoded.
+        """
+        name = shard_name(k)
+        for key in ARRAYS:
+            src = source.path / f"{source_name}.{key}.npy"
+            tmp = self.path / f"{name}.{key}.tmp.npy"
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+            os.replace(tmp, self.path / f"{name}.{key}.npy")
+
+        start, stop = self.shard_range(k)
+        return {"start": start, "count": stop - start, "rows": source.manifest["shards"][source_name]["rows"]}
+
+    def commit(self, k, entry):
+        self.manifest["shards"][shard_name(k)] = entry
+        write_json(self.manifest_path, self.manifest)
+
+
+class ShardReader:
+    """
+    Read-only view over a complete sharded export; arrays are memory-mapped, nothing is loaded up front.
+    The maps are opened lazily and dropped on pickling, so each DataLoader worker opens its own.
+    `mmap_mode="c"` (copy-on-write) gives writable arrays, e.g. for `torch.from_numpy`, without copying.
+    """
+
+    def __init__(self, path, mmap_mode="r"):
+        self.path = Path(path)
+        self.mmap_mode = mmap_mode
+        with (self.path / MANIFEST).open() as f:
+            self.manifest = json.load(f)
+        self.shard_size = self.manifest["shard_size"]
+        self.num_features = self.manifest["num_features"]
+
+        self.names = [shard_name(k) for k in range(-(-self.manifest["num_samples"] // self.shard_size))]
+        missing = [name for name in self.names if name not in self.manifest["shards"]]
+        if missing:
+            raise ValueError(f"{self.path} is incomplete ({len(missing)} shards missing), resume the export first")
+
+        self._shards = None
+        self._hash_index = None
+
+    @property
+    def shards(self):
+        if self._shards is None:
+            self._shards = [
+                {key: np.load(self.path / f"{name}.{key}.npy", mmap_mode=self.mmap_mode) for key in ARRAYS}
+                for name in self.names
+            ]
+        return self._shards
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        state["_hash_index"] = None
+        return state
+
+    def hash_index(self):
+        """
+        {content hash: sample index} and {all hashes of a shard: shard name}, built on first use.
+        """
+        if self._hash_index is None:
+            samples, shards = {}, {}
+            for k, (name, shard) in enumerate(zip(self.names, self.shards)):
+                hashes = np.asarray(shard["hashes"])
+                shards.setdefault(hashes.tobytes(), name)
+                for i, h in enumerate(hashes):
+                    samples.setdefault(h.tobytes(), k * self.shard_size + i)
+            self._hash_index = samples, shards
+        return self._hash_index
+
+    def find(self, content_hash):
+        """
+        The sample with this content hash as (features, root_type, dims), or None.
+        """
+        idx = self.hash_index()[0].get(content_hash)
+        return None if idx is None else self[idx]
+
+    def find_shard(self, hashes):
+        """
+        Name of a shard holding exactly these samples in this order, or None.
+        """
+        return self.hash_index()[1].get(hashes_array(hashes).tobytes())
+
+    def __len__(self):
+        return self.manifest["num_samples"]
+
+    def locate(self, idx):
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Index {idx} out of range")
+        return self.shards[idx // self.shard_size], idx % self.shard_size
+
+    def __getitem__(self, idx):
+        shard, i = self.locate(idx)
+        offsets = shard["offsets"]
+        features = shard["values"][offsets[i]:offsets[i + 1]]
+        return features, (int(shard["types"][i]),), tuple(shard["dims"][i].tolist())
+
+    def lengths(self):
+        """
+        Number of node rows per sample, for every sample (cheap: reads the offsets only).
+        """
+        return np.concatenate([np.diff(shard["offsets"]) for shard in self.shards]) if self.shards else np.zeros(0, dtype=np.int64)
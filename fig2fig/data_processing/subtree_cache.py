@@ -0,0 +1,130 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from data_processing.encoders import encode_nodes, encode_r, feature_position, NODE_CHANNELS, NODE_COLUMNS, NODE_FEATURES
+
+# subtrees rooted at these types are looked up in the cache
+CACHED_TYPES = ('INSTANCE', 'COMPONENT')
+
+# the only features of a subtree that depend on where it is placed
+X = feature_position('x')
+Y = feature_position('y')
+DEPTH = feature_position('depth')
+
+
+class SubtreeCache:
+    """
+    LRU cache of encoded INSTANCE / COMPONENT subtrees, bounded by `max_bytes` of feature arrays.
+
+    Subtrees are keyed by a structural hash of their rows relative to the subtree root (root x / y left out,
+    depths relative to the root), so every copy of the same component encodes once. A hit is patched back
+    into place by setting the root x / y and shifting the depth feature.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, nodes):
+        """
+        Structural hash of a subtree (a contiguous run of `FigmaNodesDataset.collect_nodes` output),
+        or None when it can't be cached.
+        """
+        root_depth = nodes[0]["depth"]
+        if root_depth is None or any(node["depth"] is None for node in nodes):
+            return None
+
+        h = hashlib.blake2b(digest_size=16)
+        for i, node in enumerate(nodes):
+            values = {column: node.get(column) for column in NODE_COLUMNS}
+            values["depth"] = node["depth"] - root_depth
+            if i == 0:
+                values["x"] = values["y"] = None
+            # subtree sizes pin down the tree shape
+            h.update(repr((node["_size"], list(values.values()))).encode())
+        return h.digest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, features, root_depth):
+        if key in self.entries or features.nbytes > self.max_bytes:
+            return
+        self.entries[key] = (features, root_depth)
+        self.bytes += features.nbytes
+        while self.bytes > self.max_bytes:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def encode(self, nodes):
+        """
+        Same as `encode_nodes(nodes)` for the rows of one sample (from `FigmaNodesDataset.collect_nodes`),
+        taking cached subtrees from the cache and adding the missing ones.
+        """
+        plain = [] # rows encoded in this call
+        misses = {} # key -> (start, stop) of its first copy in this sample
+        hits = [] # (start, stop, key, cached (features, root_depth) or None for a copy of a miss)
+
+        i = 0
+        while i < len(nodes):
+            node = nodes[i]
+            if node["type"] in CACHED_TYPES:
+                stop = i + node["_size"]
+                key = self.key(nodes[i:stop])
+                if key is not None:
+                    if key in misses:
+                        # another copy within this sample, filled from the first one below
+                        self.hits += 1
+                        hits.append((i, stop, key, None))
+                    else:
+                        # kept here: putting this sample's misses below can evict it from the LRU
+                        entry = self.get(key)
+                        if entry is not None:
+                            hits.append((i, stop, key, entry))
+                        else:
+                            misses[key] = (i, stop)
+                            plain.extend(range(i, stop))
+                    i = stop
+                    continue
+            plain.append(i)
+            i += 1
+
+        matrix = np.empty((len(nodes), len(NODE_CHANNELS), NODE_FEATURES), dtype=np.float32)
+        if plain:
+            matrix[plain] = encode_nodes([nodes[j] for j in plain])
+
+        encoded = {}
+        for key, (start, stop) in misses.items():
+            encoded[key] = (matrix[start:stop].copy(), nodes[start]["depth"])
+            self.put(key, *encoded[key])
+
+        for start, stop, key, entry in hits:
+            features, root_depth = entry if entry is not None else encoded[key]
+            root = nodes[start]
+            matrix[start:stop] = features
+            matrix[start:stop, DEPTH[0], DEPTH[1]] += root["depth"] - root_depth
+            matrix[start, X[0], X[1]] = encode_r(root.get("x"))
+            matrix[start, Y[0], Y[1]] = encode_r(root.get("y"))
+
+        return matrix
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "bytes": self.bytes}
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0
+        return (f"Subtree cache: {self.hits}/{lookups} hits ({rate:.1%}), {len(self.entries)} entries, "
+                f"{self.bytes / 2**20:.1f}MiB, {self.evictions} evictions")
+
@@ -1,11 +1,19 @@
+import os
+import ast
 import json
 import click
 import sqlite3
+import hashlib
+import multiprocessing
+from contextlib import contextmanager
+import numpy as np
 from pathlib import Path
 import torch
 from tqdm import tqdm
 from torch.utils.data import Dataset
-from data_processing.encoders import encode_border_alignment, encode_constraint_horizontal, encode_constraint_vertical, encode_counter_axis_align_items, encode_counter_axis_sizing_mode, encode_export_settings, encode_font_family, encode_font_style, encode_font_weight, encode_layout_align, encode_layout_grow, encode_layout_mode, encode_layout_positioning, encode_primary_axis_align_items, encode_primary_axis_sizing_mode, encode_text_align, encode_text_align_vertical, encode_text_auto_resize, encode_text_decoration, encode_type, decode_hex8, encode_tobinary, encode_is_boolean, encode_r
+from data_processing.shards import ShardWriter, ShardReader, shard_name
+from data_processing.subtree_cache import SubtreeCache
+from data_processing.encoders import encode_type, encode_nodes, NODE_CHANNELS, NODE_FEATURES, ENCODER_VERSION
 
 target_features = [
     'type', # one-hot
@@ -69,45 +77,328 @@ target_features = [
 ]
 
 class NodesDB:
+    # indexes the lookups below rely on; created by `prepare_db` (--prepare-db) when missing
+    INDEXES = {
+        # node_id / parent_id equality lookups (get_sample_by_node_id, get_subtree)
+        "idx_nodes_parent_node": "CREATE INDEX IF NOT EXISTS idx_nodes_parent_node ON nodes (parent_id, node_id)",
+        # covering index for the root filter in `where()` (type equality first, then the range columns)
+        "idx_nodes_roots": "CREATE INDEX IF NOT EXISTS idx_nodes_roots ON nodes (type, depth, width)",
+    }
+
+    # read-only tuning: the exporter never writes to the nodes db
+    PRAGMAS = {
+        "mmap_size": 1 << 34, # 16GiB, capped by sqlite's compile-time max
+        "cache_size": -(1 << 18), # 256MiB (negative means KiB)
+        "temp_store": "MEMORY",
+        "query_only": "ON",
+    }
+
     def __init__(self, db_path, max, max_depth):
-        self.conn = sqlite3.connect(db_path)
-        self.cursor = self.conn.cursor()
-        self.column_names = self.get_column_names()
+        self.db_path = Path(db_path)
         self.max = max
         self.max_depth = max_depth
-    
+        self._conn = None
+        self._cursor = None
+        self._pid = None
+        self.column_names = self.get_column_names()
+        self.has_edges = self.table_exists("edges")
+        # built here (not lazily) so pool workers only ever map the finished file
+        self._roots = self.load_roots()
+
+    @property
+    def conn(self):
+        # opened lazily, once per process: a NodesDB can be handed to DataLoader / export pool workers
+        # and each of them gets its own connection (sqlite connections must not cross a fork)
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = self.connect(self.db_path)
+            self._cursor = self._conn.cursor()
+            self._pid = os.getpid()
+        return self._conn
+
+    @property
+    def cursor(self):
+        self.conn
+        return self._cursor
+
+    @property
+    def roots(self):
+        if self._roots is None:
+            self._roots = self.load_roots()
+        return self._roots
+
+    def __getstate__(self):
+        # connections can't be pickled and the roots are re-mapped from their file on demand
+        state = self.__dict__.copy()
+        state.update(_conn=None, _cursor=None, _pid=None, _roots=None)
+        return state
+
+    @classmethod
+    def connect(cls, db_path):
+        """
+        Open the db read-only (by uri) with the read-optimized pragmas.
+        """
+        conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+        for key, value in cls.PRAGMAS.items():
+            conn.execute(f"PRAGMA {key} = {value}")
+        return conn
+
+    @classmethod
+    def missing_indexes(cls, conn):
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        return [name for name in cls.INDEXES if name not in existing]
+
+    @classmethod
+    def prepare_db(cls, db_path):
+        """
+        Create the indexes NodesDB needs (if missing), build the edges table (if missing) and refresh the planner statistics.
+        Returns the names of the created indexes.
+        """
+        conn = sqlite3.connect(db_path)
+        try:
+            missing = cls.missing_indexes(conn)
+            for name in missing:
+                print(f"Creating index {name}")
+                conn.execute(cls.INDEXES[name])
+            build_edges = not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'edges'").fetchone()
+            if build_edges:
+                print("Building edges table")
+                cls.build_edges(conn)
+            if missing or build_edges:
+                conn.execute("ANALYZE")
+            conn.commit()
+        finally:
+            conn.close()
+        return missing
+
+    @classmethod
+    def build_edges(cls, conn):
+        """
+        Materialize the `children` repr strings once into edges(parent_id, child_id, ordinal),
+        where both ids are nodes rowids (node ids alone are not unique across files).
+        Children are resolved the same way as `get_sample_by_node_id`: by (parent node_id, node_id), first rowid wins.
+        Children that resolve to no row are left out.
+        """
+        conn.execute("CREATE TEMP TABLE raw_edges (parent_id INTEGER, parent_node_id TEXT, node_id TEXT, ordinal INTEGER)")
+        parents = conn.execute("SELECT rowid, node_id, children FROM nodes WHERE children IS NOT NULL AND children != ''")
+        conn.executemany(
+            "INSERT INTO raw_edges VALUES (?, ?, ?, ?)",
+            (
+                (rowid, node_id, child_id, ordinal)
+                for rowid, node_id, children in parents
+                for ordinal, child_id in enumerate(safe_loads(children))
+            ),
+        )
+
+        # (parent_id, ordinal) is the only access path, so cluster the table on it
+        conn.execute("""
+            CREATE TABLE edges (
+                parent_id INTEGER NOT NULL,
+                child_id INTEGER NOT NULL,
+                ordinal INTEGER NOT NULL,
+                PRIMARY KEY (parent_id, ordinal)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            INSERT INTO edges (parent_id, child_id, ordinal)
+            SELECT parent_id, child_id, ordinal FROM (
+                SELECT e.parent_id, e.ordinal, (
+                    SELECT MIN(n.rowid) FROM nodes n WHERE n.parent_id = e.parent_node_id AND n.node_id = e.node_id
+                ) AS child_id
+                FROM temp.raw_edges e
+            )
+            WHERE child_id IS NOT NULL
+        """)
+        conn.execute("DROP TABLE temp.raw_edges")
+
+    def query_plan(self):
+        """
+        EXPLAIN QUERY PLAN for each query the exporter runs, as {query: [plan lines]}.
+        """
+        queries = {
+            "roots": (f"SELECT rowid FROM nodes WHERE {self.where()} ORDER BY rowid", ()),
+            "sample": ("SELECT rowid, * FROM nodes WHERE rowid = ?", (0,)),
+            "children": (self.node_ids_query(1), ("", "")),
+        }
+        if self.has_edges:
+            queries["edges"] = (self.edges_query(1), (0,))
+        plans = {}
+        for name, (query, params) in queries.items():
+            self.cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)
+            plans[name] = [row[-1] for row in self.cursor.fetchall()]
+        return plans
+
     def where(self):
+        if self.max_depth is None:
+            return "type == 'FRAME' AND width <= 1920"
         return f"depth <= {self.max_depth} AND type == 'FRAME' AND width <= 1920"
 
     def get_column_names(self):
+        # every query selects `rowid, *`; the rowid is kept on the row as `_rowid`
         self.cursor.execute("PRAGMA table_info(nodes)")
-        return [column_info[1] for column_info in self.cursor.fetchall()]
+        return ["_rowid"] + [column_info[1] for column_info in self.cursor.fetchall()]
+
+    def table_exists(self, name):
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+        return self.cursor.fetchone() is not None
+
+    def cache_path(self, kind):
+        """
+        Path of a materialized per-root array (e.g. "roots") for the current filter, stored next to the db.
+        """
+        key = hashlib.sha1(self.where().encode()).hexdigest()[:12]
+        return self.db_path.with_name(f"{self.db_path.stem}.{kind}-{key}.npy")
+
+    def roots_path(self):
+        return self.cache_path("roots")
+
+    def load_cached(self, kind, build):
+        """
+        Load the `kind` array, or build it with `build()` and save it.
+        The file is invalidated when the db file is modified after it was written.
+        """
+        path = self.cache_path(kind)
+        if path.exists() and path.stat().st_mtime >= self.db_path.stat().st_mtime:
+            return np.load(path, mmap_mode='r')
+
+        array = build()
+        # write to a temp file first so an interrupted build never leaves a partial list behind
+        tmp = path.with_suffix(".tmp.npy")
+        np.save(tmp, array)
+        os.replace(tmp, path)
+        return array
+
+    def load_roots(self):
+        """
+        Load (or build once) the rowids of all rows matching `where()`, in rowid order.
+        """
+        def build():
+            self.cursor.execute(f"SELECT rowid FROM nodes WHERE {self.where()} ORDER BY rowid")
+            return np.fromiter((row[0] for row in self.cursor), dtype=np.int64)
+
+        return self.load_cached("roots", build)
+
+    def load_subtree_sizes(self):
+        """
+        Load (or count once) the number of nodes of every root's subtree (itself included), in `roots` order.
+        """
+        def build():
+            return np.fromiter((self.subtree_size(self.get_sample(idx)) for idx in range(len(self.roots))),
+                               dtype=np.int64, count=len(self.roots))
+
+        return self.load_cached("sizes", build)
 
     def get_sample_count(self):
-        if self.max_depth is None:
-            self.cursor.execute("SELECT COUNT(*) FROM nodes")
-        else:
-            self.cursor.execute(f"SELECT COUNT(*) FROM nodes WHERE {self.where()}")
-        count = self.cursor.fetchone()[0]
+        count = len(self.roots)
         return min(count, self.max) if self.max else count
 
     def get_sample(self, idx):
-        self.cursor.execute(f"SELECT * FROM nodes WHERE {self.where()} LIMIT 1 OFFSET {idx}")
+        if idx < 0 or idx >= len(self.roots):
+            return None
+        self.cursor.execute("SELECT rowid, * FROM nodes WHERE rowid = ?", (int(self.roots[idx]),))
         row = self.cursor.fetchone()
         if row:
             return dict(zip(self.column_names, row))
         return None
-    
+
     def get_sample_by_node_id(self, node_id, parent_id):
-        self.cursor.execute(f"SELECT * FROM nodes WHERE node_id='{node_id}' AND parent_id='{parent_id}'")
+        self.cursor.execute("SELECT rowid, * FROM nodes WHERE node_id = ? AND parent_id = ? ORDER BY rowid", (node_id, parent_id))
         row = self.cursor.fetchone()
         if row:
             return dict(zip(self.column_names, row))
         return None
 
+    @staticmethod
+    def node_ids_query(n):
+        # the IN (SELECT ...) form lets sqlite search idx_nodes_parent_node per pair; a bare IN (VALUES ...) scans
+        values = ", ".join(["(?, ?)"] * n)
+        return f"SELECT rowid, * FROM nodes WHERE (parent_id, node_id) IN (SELECT column1, column2 FROM (VALUES {values})) ORDER BY rowid"
+
+    def get_samples_by_node_ids(self, keys, chunk_size=400):
+        """
+        Fetch many nodes at once by (parent_id, node_id) pairs.
+        Returns a dict keyed by the pair; if a pair matches more than one row, the first row (by rowid) wins,
+        same as `get_sample_by_node_id`.
+        """
+        keys = list(keys)
+        rows = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            params = [v for key in chunk for v in key]
+            self.cursor.execute(self.node_ids_query(len(chunk)), params)
+            for row in self.cursor.fetchall():
+                row = dict(zip(self.column_names, row))
+                rows.setdefault((row["parent_id"], row["node_id"]), row)
+        return rows
+
+    @staticmethod
+    def edges_query(n):
+        values = ", ".join(["?"] * n)
+        return f"SELECT e.parent_id, n.rowid, n.* FROM edges e JOIN nodes n ON n.rowid = e.child_id WHERE e.parent_id IN ({values}) ORDER BY e.parent_id, e.ordinal"
+
+    def get_children_by_edges(self, parents, chunk_size=900):
+        """
+        Children of many nodes at once through the edges table: {parent rowid: [child rows, in order]}.
+        """
+        children = {parent["_rowid"]: [] for parent in parents}
+        rowids = list(children)
+        for i in range(0, len(rowids), chunk_size):
+            chunk = rowids[i:i + chunk_size]
+            self.cursor.execute(self.edges_query(len(chunk)), chunk)
+            for row in self.cursor.fetchall():
+                children[row[0]].append(dict(zip(self.column_names, row[1:])))
+        return children
+
+    def get_children_by_node_ids(self, parents):
+        """
+        Same as `get_children_by_edges`, parsing the `children` lists (for dbs without an edges table).
+        Children that resolve to no row are left out, as in `build_edges`.
+        """
+        children = {parent["_rowid"]: get_children(parent) for parent in parents}
+        parent_ids = {parent["_rowid"]: parent["node_id"] for parent in parents}
+        fetched = self.get_samples_by_node_ids(
+            dict.fromkeys((parent_ids[rowid], child_id) for rowid, child_ids in children.items() for child_id in child_ids))
+        return {
+            rowid: [
+                fetched[parent_ids[rowid], child_id] for child_id in child_ids if (parent_ids[rowid], child_id) in fetched
+            ]
+            for rowid, child_ids in children.items()
+        }
+
+    def get_subtree(self, root):
+        """
+        Fetch every descendant of `root` with one query per depth level (instead of one query per node).
+        Returns a dict of {parent rowid: [child rows, in order]}.
+        """
+        subtree = {}
+        level = [root]
+        while level:
+            if self.has_edges:
+                children = self.get_children_by_edges(level)
+            else:
+                children = self.get_children_by_node_ids(level)
+            subtree.update(children)
+            # the same child can be listed twice; fetch its own children once
+            level = list({
+                child["_rowid"]: child
+                for rows in children.values()
+                for child in rows
+                if child["_rowid"] not in subtree
+            }.values())
+        return subtree
+
+    def subtree_size(self, root, subtree=None):
+        """
+        Number of rows `FigmaNodesDataset.collect_nodes` returns for `root` (a child listed twice counts twice).
+        """
+        if subtree is None:
+            subtree = self.get_subtree(root)
+        return 1 + sum(self.subtree_size(child, subtree) for child in subtree.get(root["_rowid"], []))
+
 class FigmaNodesDataset(Dataset):
-    def __init__(self, db, max, max_depth):
+    def __init__(self, db, max, max_depth, subtree_cache_mb=None):
         self.nodes_db = NodesDB(db, max, max_depth)
+        # optional: encode repeated component subtrees once (see data_processing/subtree_cache.py)
+        self.subtree_cache = SubtreeCache(subtree_cache_mb * 2**20) if subtree_cache_mb else None
 
         self.num_samples = self.nodes_db.get_sample_count()
         print(f"Loaded {self.num_samples} samples")
@@ -115,135 +406,46 @@ class FigmaNodesDataset(Dataset):
     def __len__(self):
         return self.num_samples
     
-    def extract_features_recursive(self, node: dict):
-        dimension_features = (
-            encode_r(node["x"]), encode_r(node["y"]),
-            encode_r(node["width"]), encode_r(node["height"]),
-            encode_r(node["depth"]),
-            node['n_children'] or 0,
-            encode_r(node.get("rotation", 0)),
-        )
-
-        container_features = (
-            node["opacity"],
-            encode_tobinary(node.get("background_image")),
-        )
-
-        background_color_features = (
-            *decode_hex8(node.get("background_color")),
-        )
-
-        text_features = (
-            encode_r(node.get("opacity", 1)),
-            encode_r(node.get("n_characters", 0)),
-            encode_font_family(node.get("font_family")),
-            encode_font_weight(node.get("font_weight")),
-            encode_r(node.get("font_size")),
-            encode_font_style(node.get("font_style")),
-            encode_text_decoration(node.get("text_decoration")),
-            encode_text_align(node.get("text_align")),
-            encode_text_align_vertical(node.get("text_align_vertical")),
-            encode_text_auto_resize(node.get("text_auto_resize")),
-            encode_r(node.get("letter_spacing")),
-        )
-
-        text_container_features = (
-            *decode_hex8(node.get("color")),
-        )
-
-        layout_constraint_features = (
-            encode_constraint_vertical(node.get("constraint_vertical")),
-            encode_constraint_horizontal(node.get("constraint_horizontal")),
-        )
-
-        layout_flex_features = (
-            encode_layout_align(node.get("layout_align")),
-            encode_layout_mode(node.get("layout_mode")),
-            encode_layout_positioning(node.get("layout_positioning")),
-            encode_layout_grow(node.get("layout_grow")),
-            encode_primary_axis_sizing_mode(node.get("primary_axis_sizing_mode")),
-            encode_counter_axis_sizing_mode(node.get("counter_axis_sizing_mode")),
-            encode_primary_axis_align_items(node.get("primary_axis_align_items")),
-            encode_counter_axis_align_items(node.get("counter_axis_align_items")),
-            encode_is_boolean(node.get("reverse")),
-        )
-
-        layout_padding_features = (
-            encode_r(node.get("padding_top")),
-            encode_r(node.get("padding_left")),
-            encode_r(node.get("padding_right")),
-            encode_r(node.get("padding_bottom")),
-        )
-
-        layout_gap_features = (
-            encode_r(node.get("gap")),
-        )
-
-        border_features = (
-            encode_border_alignment(node.get("border_alignment")),
-            encode_r(node.get("border_width")),
-            encode_r(node.get("border_radius")),
-        )
-
-        border_color_features = (
-            *decode_hex8(node.get("border_color")),
-        )
-
-        box_shadow_features = (
-            encode_r(node.get("box_shadow_offset_x")),
-            encode_r(node.get("box_shadow_offset_y")),
-            encode_r(node.get("box_shadow_blur")),
-            encode_r(node.get("box_shadow_spread")),
-        )
-
-        _aspect_ratio = (
-            encode_r(node.get("aspect_ratio")),
-        )
-
-        _is_mask = (
-            encode_is_boolean(node.get("is_mask")),
-        )
-
-        _export_settings = (
-            encode_export_settings(node.get("export_settings")),
-        )
-
-        # Encode one-hot features
-        type_encoded = encode_type(node["type"])
-
-        features = [
-            (type_encoded,),
-            dimension_features,
-            container_features,
-            background_color_features,
-            border_features,
-            border_color_features,
-            text_features,
-            text_container_features,
-            layout_constraint_features,
-            layout_flex_features,
-            layout_padding_features,
-            layout_gap_features,
-            box_shadow_features,
-            _aspect_ratio,
-            _is_mask,
-            _export_settings,
-        ]
-
-        # Recurse through children
-        children = safe_loads(node["children"]) if node["children"] else []
-        for child_id in children:
-            child_row = self.nodes_db.get_sample_by_node_id(node_id=child_id, parent_id=node["node_id"])
-            features.extend(self.extract_features_recursive(child_row))
-
-        return features
-
-
-    def __getitem__(self, idx):
+    def collect_nodes(self, node: dict, subtree: dict = None):
+        """
+        The node and its descendants as a flat list, in depth-first order (the row order of the encoded features).
+        Each row gets its subtree size (itself included) as `_size`.
+        """
+        if subtree is None:
+            subtree = self.nodes_db.get_subtree(node)
+
+        nodes = [node]
+        for child_row in subtree.get(node["_rowid"], []):
+            nodes.extend(self.collect_nodes(child_row, subtree))
+        node["_size"] = len(nodes)
+        return nodes
+
+    def get_nodes(self, idx):
+        """
+        Root `idx` and its descendants, as rows in traversal order.
+        """
         # Get data from the table
         row = self.nodes_db.get_sample(idx)
         if row is None:
             raise IndexError(f"Index {idx} out of range")
+        return self.collect_nodes(row)
+
+    def content_hash(self, nodes):
+        """
+        16-byte hash of a sample's rows (in traversal order), the table schema and the encoder version.
+        Samples with equal hashes encode to the same features.
+        """
+        columns = self.nodes_db.column_names[1:] # without _rowid, which is not content
+        h = hashlib.blake2b(f"{ENCODER_VERSION}:{columns}".encode(), digest_size=16)
+        for node in nodes:
+            h.update(repr([node[column] for column in columns]).encode())
+        return h.digest()
+
+    def __getitem__(self, idx):
+        return self.encode_sample(self.get_nodes(idx))
+
+    def encode_sample(self, nodes):
+        row = nodes[0]
 
         # input parameters
         root_width = row["width"]
@@ -251,38 +453,173 @@ class FigmaNodesDataset(Dataset):
         root_type = encode_type(row["type"])
 
 
-        # Extract features
-        features = self.extract_features_recursive(row)
-
-        num_channels = len(features)
-        num_features = max(len(channel) for channel in features)
-
-        tensor_features = torch.zeros((num_channels, num_features), dtype=torch.float32)
-
-        for i, channel in enumerate(features):
-            try:
-                tensor_features[i, :len(channel)] = torch.tensor(channel, dtype=torch.float32)
-            except Exception as e:
-                print(f"{i} Failed to convert {channel} to tensor")
-                raise e
+        # Extract features (one columnar pass over the whole subtree)
+        if self.subtree_cache is not None:
+            features = self.subtree_cache.encode(nodes)
+        else:
+            features = encode_nodes(nodes)
+        tensor_features = torch.from_numpy(features.reshape(-1, NODE_FEATURES))
 
         return tensor_features, (root_type,), (root_width, root_height)
 
+    def sample_lengths(self):
+        """
+        Number of feature rows of every sample (as returned by `__getitem__`), without encoding anything.
+        For length-bucketed batching (data_processing/sampler.py).
+        The subtree sizes are counted once and stored next to the db, like the roots.
+        """
+        return (self.nodes_db.load_subtree_sizes() * len(NODE_CHANNELS)).tolist()
+
     def get_input_dim(self):
         sample, _ = self[0]  # Get a sample from the dataset
         input_dim = sample.numel()  # Calculate the number of elements in the flattened tensor
         return input_dim
     
-    def save_tensors(self, file, max):
-        sample_data = []
-        for idx in tqdm(range(max) if max else range(self.num_samples)):
-            tensor_features, root_type, dimensions = self[idx]
-            sample_data.append((tensor_features, root_type, dimensions))
+    def save_tensors(self, file, max, workers=1):
+        indices = range(max) if max else range(self.num_samples)
+        with export_pool(workers, self) as pool:
+            samples = pool.imap(export_sample, indices, chunksize=64) if pool else map(self.encode_with_cache_stats, indices)
+            sample_data, hits, misses = [], 0, 0
+            for sample, sample_hits, sample_misses in tqdm(samples, total=len(indices)):
+                sample_data.append(sample)
+                hits += sample_hits
+                misses += sample_misses
         torch.save(sample_data, file)
 
+        if self.subtree_cache is not None:
+            # summed over samples, since each worker has its own cache
+            lookups = hits + misses
+            print(f"Subtree cache: {hits}/{lookups} hits ({hits / lookups if lookups else 0:.1%})")
+
+    def encode_with_cache_stats(self, idx):
+        """
+        Sample `idx` with the subtree cache hits and misses its encoding took (0, 0 without a cache).
+        """
+        if self.subtree_cache is None:
+            return self[idx], 0, 0
+        before = self.subtree_cache.stats()
+        sample = self[idx]
+        after = self.subtree_cache.stats()
+        return sample, after["hits"] - before["hits"], after["misses"] - before["misses"]
+
+    def encode_shard(self, writer, k, previous=None):
+        """
+        Encode and write shard `k`. With a `previous` export (ShardReader), samples whose content hash is already
+        there are copied instead of encoded, and a shard whose samples all match one previous shard is linked as a whole.
+        """
+        start, stop = writer.shard_range(k)
+        trees = [self.get_nodes(idx) for idx in range(start, stop)]
+        hashes = [self.content_hash(nodes) for nodes in trees]
+
+        if previous is not None:
+            name = previous.find_shard(hashes)
+            if name is not None:
+                return {**writer.link_shard(k, previous, name), "reused": len(hashes), "linked": True}
+
+        samples = []
+        reused = 0
+        cache_before = self.subtree_cache.stats() if self.subtree_cache is not None else None
+        for nodes, content_hash in zip(trees, hashes):
+            sample = previous.find(content_hash) if previous is not None else None
+            if sample is None:
+                tensor_features, root_type, dimensions = self.encode_sample(nodes)
+                sample = (tensor_features.numpy(), root_type, dimensions)
+            else:
+                reused += 1
+            samples.append(sample)
+        entry = {**writer.write_arrays(k, samples, hashes), "reused": reused}
+        if cache_before is not None:
+            cache_after = self.subtree_cache.stats()
+            entry["cache_hits"] = cache_after["hits"] - cache_before["hits"]
+            entry["cache_misses"] = cache_after["misses"] - cache_before["misses"]
+        return entry
+
+    def save_shards(self, path, max, shard_size=1024, workers=1, previous=None):
+        """
+        Streaming export: encode `shard_size` samples at a time into a sharded directory (see data_processing/shards.py).
+        Memory stays bounded by one shard (per worker), and re-running with the same arguments resumes after the last completed shard.
+        With `workers` > 1 shards are encoded in parallel; each shard covers a fixed index range, so the result does not depend on the worker count.
+        With a `previous` export directory, only new or changed samples are encoded (see `encode_shard`).
+        """
+        num_samples = min(max, self.num_samples) if max else self.num_samples
+        writer = ShardWriter(path, num_samples, shard_size, NODE_FEATURES, meta={
+            "db": self.nodes_db.db_path.name,
+            "where": self.nodes_db.where(),
+            "encoder_version": ENCODER_VERSION,
+        })
+        previous = ShardReader(previous) if previous else None
+
+        pending = writer.pending()
+        if len(pending) < writer.num_shards:
+            print(f"Resuming export: {writer.num_shards - len(pending)}/{writer.num_shards} shards already written")
+
+        with tqdm(total=num_samples, initial=num_samples - sum(len(range(*writer.shard_range(k))) for k in pending)) as progress_bar:
+            with export_pool(workers, self, writer, previous) as pool:
+                if pool:
+                    shards = pool.imap_unordered(export_shard, pending)
+                else:
+                    shards = ((k, self.encode_shard(writer, k, previous)) for k in pending)
+                # only this process writes the manifest
+                for k, entry in shards:
+                    writer.commit(k, entry)
+                    progress_bar.update(entry["count"])
+
+        if previous is not None:
+            entries = [writer.manifest["shards"][shard_name(k)] for k in pending]
+            reused = sum(entry["reused"] for entry in entries)
+            linked = sum(1 for entry in entries if entry.get("linked"))
+            encoded = sum(entry["count"] for entry in entries) - reused
+            print(f"Incremental export: {encoded} samples encoded, {reused} reused ({linked}/{len(entries)} shards linked as is)")
+
+        if self.subtree_cache is not None:
+            # summed over shards, since each worker has its own cache
+            hits = sum(writer.manifest["shards"][shard_name(k)].get("cache_hits", 0) for k in pending)
+            lookups = hits + sum(writer.manifest["shards"][shard_name(k)].get("cache_misses", 0) for k in pending)
+            print(f"Subtree cache: {hits}/{lookups} hits ({hits / lookups if lookups else 0:.1%})")
+
+
+# state of an export worker process, set by `init_export_worker`
+export_dataset = None
+export_writer = None
+export_previous = None
+
+def init_export_worker(dataset, writer, previous):
+    global export_dataset, export_writer, export_previous
+    export_dataset = dataset
+    export_writer = writer
+    export_previous = previous
+    # one process per core already, don't let torch oversubscribe
+    torch.set_num_threads(1)
+
+def export_sample(idx):
+    return export_dataset.encode_with_cache_stats(idx)
+
+def export_shard(k):
+    return k, export_dataset.encode_shard(export_writer, k, export_previous)
+
+@contextmanager
+def export_pool(workers, dataset, writer=None, previous=None):
+    """
+    A process pool whose workers each hold their own copy of the dataset (and their own db connection),
+    or None when running in-process.
+    """
+    if not workers or workers <= 1:
+        yield None
+        return
+    with multiprocessing.Pool(workers, initializer=init_export_worker, initargs=(dataset, writer, previous)) as pool:
+        yield pool
+
+def get_children(node):
+    return safe_loads(node["children"]) if node["children"] else []
+
 def safe_loads(s):
     try:
         return json.loads(s.replace("'", "\""))
+    except json.JSONDecodeError:
+        pass
+    # the lists are python reprs; ids with quotes in them only survive a real literal parse
+    try:
+        return ast.literal_eval(s)
     except Exception as e:
         print(f"Failed to parse: {s}")
         raise e
@@ -294,13 +631,33 @@ def safe_loads(s):
 @click.option("--max", type=click.INT, required=False, default=None)
 @click.option("--depth", type=click.INT, required=False, default=None)
 @click.option("--skip", type=click.INT, required=False, default=None)
-def main(db, checkpoint, max, depth, skip):
+@click.option("--prepare-db", is_flag=True, default=False, help="Create the indexes the exporter needs (writes to the db)")
+@click.option("--shard-size", type=click.INT, required=False, default=None, help="Stream the export into shards of this many samples (resumable)")
+@click.option("--workers", type=click.INT, required=False, default=1, help="Number of export processes")
+@click.option("--previous", type=click.Path(exists=True, file_okay=False), required=False, default=None, help="Previous sharded export to reuse unchanged samples from")
+@click.option("--subtree-cache-mb", type=click.INT, required=False, default=None, help="Memory budget of the repeated component subtree cache (per worker)")
+def main(db, checkpoint, max, depth, skip, prepare_db, shard_size, workers, previous, subtree_cache_mb):
     db = Path(db)
     checkpoint = Path(checkpoint)
-    dataset = FigmaNodesDataset(db, max=max, max_depth=depth)
 
-    file = checkpoint / f"{db.stem}.pth"
-    dataset.save_tensors(file, max=max)
+    if prepare_db:
+        NodesDB.prepare_db(db)
+
+    dataset = FigmaNodesDataset(db, max=max, max_depth=depth, subtree_cache_mb=subtree_cache_mb)
+
+    missing = NodesDB.missing_indexes(dataset.nodes_db.conn)
+    if missing:
+        print(f"Missing indexes: {', '.join(missing)} (run with --prepare-db to create them)")
+    if not dataset.nodes_db.has_edges:
+        print("No edges table, children are parsed from their repr strings (run with --prepare-db to build it)")
+    for name, plan in dataset.nodes_db.query_plan().items():
+        print(f"Query plan [{name}]: {'; '.join(plan)}")
+
+    if shard_size:
+        dataset.save_shards(checkpoint / db.stem, max=max, shard_size=shard_size, workers=workers, previous=previous)
+    else:
+        file = checkpoint / f"{db.stem}.pth"
+        dataset.save_tensors(file, max=max, workers=workers)
 
 if __name__ == "__main__":
     main()
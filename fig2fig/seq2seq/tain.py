@@ -4,6 +4,7 @@ import torch.optim as optim
 from torch.utils.data import DataLoader, random_split
 from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pad_packed_sequence
 from dataset import FigmaNodesDataset
+from data_processing.sampler import BucketBatchSampler, padding_report
 
 # Define the Encoder
 class Encoder(nn.Module):
@@ -22,14 +23,27 @@ class Decoder(nn.Module):
     def __init__(self, output_size, hidden_size):
         super(Decoder, self).__init__()
         self.hidden_size = hidden_size
-        self.lstm_cell = nn.LSTMCell(output_size, hidden_size)
+        self.output_size = output_size
+        # an nn.LSTM (not LSTMCell) so training can run the whole sequence in one fused call;
+        # inference steps it one position at a time with the same weights
+        self.lstm = nn.LSTM(output_size, hidden_size, batch_first=True)
         self.fc = nn.Linear(hidden_size, output_size)
 
     def forward(self, x, hidden, cell):
-        hidden, cell = self.lstm_cell(x, (hidden, cell))
-        output = self.fc(hidden)
+        """
+        One step: x is (batch, output_size), hidden / cell are (1, batch, hidden_size).
+        """
+        output, (hidden, cell) = self.lstm(x.unsqueeze(1), (hidden, cell))
+        output = self.fc(output.squeeze(1))
         return output, hidden, cell
 
+    def forward_sequence(self, x, hidden, cell):
+        """
+        All steps at once: x is (batch, seq_len, output_size), the inputs of every step.
+        """
+        output, _ = self.lstm(x, (hidden, cell))
+        return self.fc(output)
+
 # Define the Seq2Seq Model
 class Seq2Seq(nn.Module):
     def __init__(self, input_size, output_size, hidden_size):
@@ -38,6 +52,42 @@ class Seq2Seq(nn.Module):
         self.decoder = Decoder(output_size, hidden_size)
 
     def forward(self, x, lengths, target=None, teacher_forcing_ratio=0.5):
+        if target is not None and self.training:
+            return self.forward_teacher_forced(x, lengths, target, teacher_forcing_ratio)
+        return self.generate(x, lengths)
+
+    def forward_teacher_forced(self, x, lengths, target, teacher_forcing_ratio=0.5):
+        """
+        Training path: the decoder runs over the whole target sequence in one fused LSTM call.
+        Scheduled sampling is a per-step mask drawn once per batch: masked-out steps are fed the model's own
+        prediction from a first (no-grad) teacher-forced pass instead of the target. With a ratio of 1 that
+        first pass is skipped.
+        """
+        batch_size = x.size(0)
+        seq_len = lengths.max().item()
+
+        hidden, cell = self.encoder(x, lengths)
+
+        # step t is fed target t - 1 (zeros for the first step)
+        start = torch.zeros(batch_size, 1, self.decoder.output_size, device=x.device)
+        decoder_inputs = torch.cat((start, target[:, :seq_len - 1]), dim=1)
+
+        if teacher_forcing_ratio < 1:
+            with torch.no_grad():
+                predictions = self.decoder.forward_sequence(decoder_inputs, hidden, cell)
+            sampled = torch.cat((start, predictions[:, :seq_len - 1]), dim=1)
+            # one draw per step, shared by the batch (same as the per-step coin flip of the step loop)
+            mask = (torch.rand(1, seq_len, 1, device=x.device) < teacher_forcing_ratio).float()
+            # the first step is always fed zeros
+            mask[:, 0] = 1
+            decoder_inputs = mask * decoder_inputs + (1 - mask) * sampled
+
+        return self.decoder.forward_sequence(decoder_inputs, hidden, cell)
+
+    def generate(self, x, lengths):
+        """
+        Inference path: decode step by step, feeding back the model's own output.
+        """
         batch_size = x.size(0)
         seq_len = lengths.max().item()
         output_size = self.decoder.output_size
@@ -52,12 +102,7 @@ class Seq2Seq(nn.Module):
         for t in range(seq_len):
             decoder_output, hidden, cell = self.decoder(decoder_input, hidden, cell)
             decoder_outputs[:, t] = decoder_output
-
-            # Use teacher forcing
-            if target is not None and torch.rand(1).item() < teacher_forcing_ratio:
-                decoder_input = target[:, t]
-            else:
-                decoder_input = decoder_output
+            decoder_input = decoder_output
 
         return decoder_outputs
 
@@ -68,6 +113,7 @@ hidden_size = 128
 batch_size = 32
 epochs = 10
 learning_rate = 0.001
+teacher_forcing_ratio = 0.5  # 1.0 = full teacher forcing (single decoder pass)
 
 # Load the dataset
 sqlite_file = "your_sqlite_file.db"
@@ -86,8 +132,16 @@ def pad_collate(batch):
     children = pad_sequence(children, batch_first=True, padding_value=0)
     return features, lengths, children
 
-train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, collate_fn=pad_collate)
-val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, collate_fn=pad_collate)
+# batch samples of similar length together, so pad_collate pads little
+lengths = dataset.sample_lengths()
+train_lengths = [lengths[i] for i in train_dataset.indices]
+val_lengths = [lengths[i] for i in val_dataset.indices]
+train_sampler = BucketBatchSampler(train_lengths, batch_size)
+val_sampler = BucketBatchSampler(val_lengths, batch_size, shuffle=False)
+print(padding_report(train_lengths, batch_size, train_sampler))
+
+train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=pad_collate)
+val_loader = DataLoader(val_dataset, batch_sampler=val_sampler, collate_fn=pad_collate)
 
 # Initialize the model, loss function, and optimizer
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -105,7 +159,7 @@ for epoch in range(epochs):
 
         # Forward pass
         optimizer.zero_grad()
-        output = model(features, lengths, target=children)
+        output = model(features, lengths, target=children, teacher_forcing_ratio=teacher_forcing_ratio)
 
         # Calculate loss and update weights
         loss = criterion(output, children)
@@ -1,41 +1,125 @@
 # generate.py
 
+import click
 import torch
-from train import VAE, input_dim, hidden_dim, latent_dim, device
+from train import VAE, CONDITIONS, hidden_dim, latent_dim, device
 
-# TODO: load the input_dim
 
-def load_vae_model(model_path, input_dim, hidden_dim, latent_dim):
+def load_vae_model(model_path, input_dim=None, hidden_dim=hidden_dim, latent_dim=latent_dim):
+    state_dict = torch.load(model_path, map_location=device)
+    # the decoder's output layer is (input_dim, hidden_dim)
+    input_dim = input_dim or state_dict["decoder.2.weight"].size(0)
     model = VAE(input_dim, hidden_dim, latent_dim)
-    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.load_state_dict(state_dict)
     model.to(device)
     return model
 
+
+class DesignGenerator:
+    """
+    Loads the decoder once and samples designs for a batch of (type, width, height) conditions in one decoder pass.
+
+    generator = DesignGenerator.from_checkpoint("trained_vae.pth", seed=0)
+    designs = generator.generate([(1, 100, 100), (2, 320, 640)], num_samples=1000)  # (2, 1000, input_dim)
+
+    With `seed`, every `generate` call draws from a seeded stream (the same sequence of calls gives the same designs);
+    `generate(..., seed=...)` makes a single call deterministic on its own.
+    The decoder can be exported to TorchScript (and loaded back with `from_torchscript`) or ONNX for a lower-latency CPU path.
+    """
+
+    def __init__(self, decoder, latent_size, device=device, seed=None, batch_size=8192):
+        self.decoder = decoder.eval()
+        self.latent_size = latent_size
+        self.device = torch.device(device)
+        # bounds the memory of one decoder pass when sampling many designs
+        self.batch_size = batch_size
+        self.generator = torch.Generator(device=self.device)
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    @classmethod
+    def from_checkpoint(cls, model_path, input_dim=None, hidden_dim=hidden_dim, latent_dim=latent_dim, device=device, **kwargs):
+        model = load_vae_model(model_path, input_dim, hidden_dim, latent_dim)
+        return cls(model.decoder.to(device), latent_dim, device=device, **kwargs)
+
+    @classmethod
+    def from_torchscript(cls, path, device=device, **kwargs):
+        extra_files = {"latent_size": ""}
+        decoder = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        return cls(decoder, int(extra_files["latent_size"]), device=device, **kwargs)
+
+    def decoder_inputs(self, conditions, num_samples=1, seed=None):
+        """
+        (len(conditions) * num_samples, latent_size + 3) decoder inputs; the samples of a condition are contiguous.
+        """
+        generator = self.generator
+        if seed is not None:
+            generator = torch.Generator(device=self.device)
+            generator.manual_seed(seed)
+
+        conditions = torch.as_tensor(conditions, dtype=torch.float32, device=self.device).reshape(-1, len(CONDITIONS))
+        _type, wh = conditions[:, :1], conditions[:, 1:]
+        condition = torch.cat((wh, _type), dim=1).repeat_interleave(num_samples, dim=0)
+        z = torch.randn(condition.size(0), self.latent_size, generator=generator, device=self.device)
+        return torch.cat((z, condition), dim=1)
+
+    def generate(self, conditions, num_samples=1, seed=None):
+        """
+        conditions: a list of (type, width, height). Returns a (len(conditions), num_samples, input_dim) numpy array.
+        """
+        inputs = self.decoder_inputs(conditions, num_samples, seed)
+        with torch.inference_mode():
+            generated = torch.cat([self.decoder(chunk) for chunk in inputs.split(self.batch_size)])
+        return generated.reshape(-1, num_samples, generated.size(-1)).cpu().numpy()
+
+    def example_inputs(self):
+        return self.decoder_inputs([(0, 1, 1)], seed=0)
+
+    def export_torchscript(self, path):
+        scripted = torch.jit.trace(self.decoder, self.example_inputs())
+        torch.jit.save(scripted, path, _extra_files={"latent_size": str(self.latent_size)})
+
+    def export_onnx(self, path):
+        """
+        The ONNX graph takes one float32 input "z" of shape (batch, latent_size + 3): latent sample, width, height, type.
+        """
+        torch.onnx.export(
+            self.decoder, (self.example_inputs(),), path,
+            input_names=["z"], output_names=["design"],
+            dynamic_axes={"z": {0: "batch"}, "design": {0: "batch"}},
+        )
+
+
 def generate_random_design(model: VAE, device, num_features, **kwargs):
     (_type, width, height) = (kwargs["type"], kwargs["width"], kwargs["height"])
+    generator = DesignGenerator(model.decoder, num_features, device=device)
+    return generator.generate([(_type, width, height)])[0]
+
+
+@click.command()
+@click.option("--model", "model_path", default="trained_vae.pth")
+@click.option("--input-dim", type=int, default=None, help="default: read from the checkpoint")
+@click.option("--type", "_type", type=int, default=1, help="root type (use an appropriate value)")
+@click.option("--width", type=float, default=100)
+@click.option("--height", type=float, default=100)
+@click.option("--samples", type=int, default=1)
+@click.option("--seed", type=int, default=None)
+@click.option("--torchscript", default=None, help="export the decoder to this TorchScript file")
+@click.option("--onnx", default=None, help="export the decoder to this ONNX file")
+def main(model_path, input_dim, _type, width, height, samples, seed, torchscript, onnx):
+    generator = DesignGenerator.from_checkpoint(model_path, input_dim, seed=seed)
+    if torchscript:
+        generator.export_torchscript(torchscript)
+        print(f"TorchScript decoder saved to {torchscript}")
+    if onnx:
+        generator.export_onnx(onnx)
+        print(f"ONNX decoder saved to {onnx}")
+
+    generated_design = generator.generate([(_type, width, height)], num_samples=samples)
+    print("Generated design:", generated_design)
+
 
-    model.eval()
-    with torch.no_grad():
-        z = torch.randn(1, num_features).to(device)
-        wh = torch.tensor([[width, height]], device=device, dtype=torch.float32)
-        _type = torch.tensor([[_type]], device=device, dtype=torch.float32)
-        generated = model.decoder(torch.cat((z, wh, _type), dim=1))
-        return generated.cpu().numpy()
-
-# Load the trained model
-model_path = "trained_vae.pth"
-model = load_vae_model(model_path, input_dim, hidden_dim, latent_dim)
-
-# Generate a random design with specific type, width, and height
-_type = 1  # Use an appropriate value for the type
-width = 100
-height = 100
-
-params = {
-    "type": _type,
-    "width": width,
-    "height": height
-}
-
-generated_design = generate_random_design(model, device, latent_dim, **params)
-print("Generated design:", generated_design)
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,68 @@
+import os
+import time
+import click
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader
+from torch.nn.utils.rnn import pad_sequence
+from pathlib import Path
 from dataset import FigmaNodesDataset
+from data_processing.shards import ShardReader
+from data_processing.sampler import BucketBatchSampler, padding_report
 import numpy as np
 from tqdm import tqdm
 from torch.utils.data import Dataset
 
 class TensorDataset(Dataset):
-    def __init__(self, saved_tensors_file):
+    def __init__(self, saved_tensors_file, pad=True):
         self.data = torch.load(saved_tensors_file)
         self.max_length = max([t.shape[0] for t, _, _ in self.data])
+        # with pad=False items keep their own length and `custom_collate` pads per batch
+        self.pad = pad
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
         tensor_features, root_type, dimensions = self.data[idx]
+        if not self.pad:
+            return tensor_features, root_type, dimensions
         padded_tensor = self.pad_tensor(tensor_features, self.max_length)
         return padded_tensor, root_type, dimensions
 
+    def lengths(self):
+        return [t.shape[0] for t, _, _ in self.data]
+
     def pad_tensor(self, tensor, target_length):
         pad_size = target_length - tensor.size(0)
         return torch.cat((tensor, torch.zeros(pad_size, tensor.size(1))), dim=0)
 
 
+class ShardedTensorDataset(Dataset):
+    """
+    Reads a sharded export (dataset.py --shard-size) through memory maps, so nothing is loaded up front.
+    Items are the unpadded (zero-copy) node rows; `custom_collate` pads each batch to its own longest sample.
+    """
+    def __init__(self, shards_dir):
+        self.reader = ShardReader(shards_dir, mmap_mode="c")
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, idx):
+        features, root_type, dimensions = self.reader[idx]
+        return torch.from_numpy(features), root_type, dimensions
+
+    def lengths(self):
+        return self.reader.lengths()
+
+
+# the decoder input is the latent sample followed by these conditions (see VAE.forward)
+CONDITIONS = ("width", "height", "type")
+LOG_VAR_LIMIT = 10
+
+
 # VAE Model
 class VAE(nn.Module):
     def __init__(self, input_dim, hidden_dim, latent_dim):
@@ -37,10 +75,10 @@ class VAE(nn.Module):
         )
 
         self.decoder = nn.Sequential(
-            nn.Linear(latent_dim, hidden_dim),
+            nn.Linear(latent_dim + len(CONDITIONS), hidden_dim),
             nn.ReLU(),
+            # features are in their own units (pixels, counts, ...), not probabilities
             nn.Linear(hidden_dim, input_dim),
-            nn.Sigmoid(),
         )
 
     def reparameterize(self, mu, log_var):
@@ -50,39 +88,86 @@ class VAE(nn.Module):
 
     def forward(self, x, _type, wh):
         h = self.encoder(x)
-        mu, log_var = torch.chunk(h, 2, dim=1)
+        mu, log_var = torch.chunk(h, 2, dim=-1)
+        # features are unnormalized (hundreds of pixels), keep exp(log_var) finite
+        log_var = log_var.clamp(-LOG_VAR_LIMIT, LOG_VAR_LIMIT)
         z = self.reparameterize(mu, log_var)
-        z = torch.cat((z, wh, _type), dim=1)  # Concatenate width, height, and root type with the latent variable
+        # Concatenate width, height, and root type with the latent variable
+        # (for (batch, nodes, features) inputs, the root's conditions go with every node row)
+        condition = torch.cat((wh, _type), dim=-1)
+        if z.dim() == 3:
+            condition = condition.unsqueeze(1).expand(-1, z.size(1), -1)
+        z = torch.cat((z, condition), dim=-1)
         x_recon = self.decoder(z)
         return x_recon, mu, log_var
 
 
 def vae_loss(recon_x, x, mu, log_var):
-    recon_loss = nn.functional.binary_cross_entropy(recon_x, x, reduction='sum')
+    """
+    Summed squared error of the reconstruction plus the KL term. The features are raw pixel / count values, which
+    the earlier Sigmoid + binary cross-entropy objective could not take as targets.
+    """
+    recon_loss = nn.functional.mse_loss(recon_x, x, reduction='sum')
     kld_loss = -0.5 * torch.sum(1 + log_var - mu.pow(2) - log_var.exp())
     return recon_loss + kld_loss
 
 
-def train(model, dataloader, device, optimizer, epochs):
+def cpu_supports_bf16():
+    """
+    Whether the CPU has native bf16 instructions (AVX512-BF16 or AMX); elsewhere bf16 autocast is emulated and slower than fp32.
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(next((line for line in f if line.startswith("flags")), "").split())
+    except OSError:
+        return False
+    return bool(flags & {"avx512_bf16", "amx_bf16"})
+
+
+def configure_cpu_threads(threads=None, interop_threads=None):
+    """
+    Explicit intra-op / inter-op thread counts (defaults: every core available to this process / 1).
+    Must run before the first parallel op, `set_num_interop_threads` fails once the pool has started.
+    """
+    threads = threads or (len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count())
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(interop_threads or 1)
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def train(model, dataloader, device, optimizer, epochs, bf16=False, log_every=1):
+    """
+    bf16: run the forward pass under CPU bf16 autocast (the loss is still computed in fp32).
+    log_every: the running loss is accumulated on the device and only read back (a sync) every `log_every` batches.
+    """
     model.train()
     for epoch in range(epochs):
-        train_loss = 0
+        train_loss = torch.zeros((), device=device)
+        samples = 0
+        start = time.perf_counter()
         progress_bar = tqdm(enumerate(dataloader), total=len(dataloader), desc=f"Epoch {epoch + 1}/{epochs}", unit="batch")
         for batch_idx, (data, _type, wh) in progress_bar:
             data = data.to(device).float()
             _type = _type.to(device=device, dtype=torch.float32).squeeze(1)  # Convert the _type tuple to a tensor
             wh = wh.to(device=device, dtype=torch.float32).squeeze(1)  # Convert the wh tuple to a tensor and fix the dimensions
-            optimizer.zero_grad()
-            recon_batch, mu, log_var = model(data, _type, wh)
-            loss = vae_loss(recon_batch, data, mu, log_var)
+            optimizer.zero_grad(set_to_none=True)
+            with torch.autocast("cpu", dtype=torch.bfloat16, enabled=bf16):
+                recon_batch, mu, log_var = model(data, _type, wh)
+            loss = vae_loss(recon_batch.float(), data, mu.float(), log_var.float())
             loss.backward()
-            train_loss += loss.item()
+            train_loss += loss.detach()
             optimizer.step()
-            progress_bar.set_description(f"Epoch {epoch + 1}/{epochs}, Loss: {train_loss / (batch_idx + 1)}")
+            samples += data.size(0)
+
+            if (batch_idx + 1) % log_every == 0 or batch_idx + 1 == len(dataloader):
+                throughput = samples / (time.perf_counter() - start)
+                progress_bar.set_description(
+                    f"Epoch {epoch + 1}/{epochs}, Loss: {train_loss.item() / (batch_idx + 1)}, {throughput:.0f} samples/s")
 
 
 def custom_collate(batch):
-    data = torch.stack([item[0] for item in batch], dim=0)
+    # pads to the longest sample in the batch (a no-op for items already padded to the dataset max)
+    data = pad_sequence([item[0] for item in batch], batch_first=True, padding_value=0)
     _type = torch.tensor([item[1] for item in batch], dtype=torch.float32).unsqueeze(1)
     wh = torch.tensor([item[2] for item in batch], dtype=torch.float32).unsqueeze(1)
     return data, _type, wh
@@ -92,22 +177,57 @@ def custom_collate(batch):
 hidden_dim = 512
 latent_dim = 64
 batch_size = 64
+bucket_batches = True  # batch samples of similar length together (see data_processing/sampler.py)
 epochs = 100
 learning_rate = 1e-3
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def main():
+@click.command()
+@click.option("--data", "saved_tensors_file", default="./checkpoints/nodes-100-100.pth", help="saved tensors file (or shards directory)")
+@click.option("--fast-cpu", is_flag=True, help="CPU training mode: explicit threads, bf16 autocast where supported, on-device loss accumulation")
+@click.option("--compile", "compile_model", is_flag=True, help="torch.compile the VAE (first batches are slow while it compiles)")
+@click.option("--threads", type=int, default=None, help="intra-op threads with --fast-cpu (default: all available cores)")
+@click.option("--interop-threads", type=int, default=None, help="inter-op threads with --fast-cpu (default: 1)")
+@click.option("--bf16/--no-bf16", default=None, help="force bf16 autocast on / off with --fast-cpu (default: only if the CPU has native bf16)")
+@click.option("--log-every", type=int, default=None, help="batches between loss readouts (default: 1, or 50 with --fast-cpu)")
+def main(saved_tensors_file, fast_cpu, compile_model, threads, interop_threads, bf16, log_every):
+    """
+    Train the VAE on exported node features.
+
+    In every mode, the decoder has a linear output trained with summed MSE on the raw features, and log_var is clamped
+    to +-10 (LOG_VAR_LIMIT). Checkpoints from the earlier Sigmoid + BCE objective still load, but were trained on a
+    different objective.
+    """
+    bf16 = bool(fast_cpu and device.type == "cpu" and (cpu_supports_bf16() if bf16 is None else bf16))
+    log_every = log_every or (50 if fast_cpu else 1)
+    if fast_cpu:
+        intra, inter = configure_cpu_threads(threads, interop_threads)
+        print(f"Fast CPU mode: {intra} intra-op / {inter} inter-op threads, bf16 autocast {'on' if bf16 else 'off'}, "
+              f"loss logged every {log_every} batches")
+
     # Load saved tensors
-    saved_tensors_file = "./checkpoints/nodes-100-100.pth"  # Replace this with the path to your saved tensors file
-    dataset = TensorDataset(saved_tensors_file)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=custom_collate)
+    if Path(saved_tensors_file).is_dir():
+        dataset = ShardedTensorDataset(saved_tensors_file)
+    else:
+        dataset = TensorDataset(saved_tensors_file, pad=not bucket_batches)
+
+    if bucket_batches:
+        lengths = dataset.lengths()
+        sampler = BucketBatchSampler(lengths, batch_size)
+        print(padding_report(lengths, batch_size, sampler))
+        dataloader = DataLoader(dataset, batch_sampler=sampler, collate_fn=custom_collate)
+    else:
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=custom_collate)
 
     input_dim = dataset[0][0].shape[1]
 
     # Initialize and train VAE
     model = VAE(input_dim, hidden_dim, latent_dim).to(device)
     optimizer = optim.Adam(model.parameters(), lr=learning_rate)
-    train(model, dataloader, device, optimizer, epochs)
+    # the compiled module shares parameters with `model`, which is what gets saved (no _orig_mod. prefix);
+    # dynamic shapes, since every length bucket pads to a different number of rows
+    compiled = torch.compile(model, dynamic=True) if compile_model else model
+    train(compiled, dataloader, device, optimizer, epochs, bf16=bf16, log_every=log_every)
 
     # Save the model
     torch.save(model.state_dict(), "vae_model.pth")
@@ -0,0 +1,195 @@
+"""
+Inference backends for the renamer, all exposing the slice of the transformers seq2seq interface `decode` uses:
+
+torch  the fp32 checkpoint in data/models
+int8   the same model with dynamically int8-quantized Linear layers
+onnx   an ONNX Runtime encoder / decoder pair
+
+    python backends.py --int8 --onnx    # export both from data/models to data/exports
+"""
+
+import os
+import argparse
+import torch
+
+# the checkpoint to serve (e.g. a student from distill.py)
+MODEL_PATH = os.environ.get("FIG2NAME_MODEL", os.path.join(os.path.dirname(__file__), "../data/models"))
+EXPORT_PATH = os.path.join(os.path.dirname(__file__), "../data/exports")
+BACKENDS = ("torch", "int8", "onnx")
+
+
+# transformers is imported where it is used, so importing this module (and predict_layer_names) stays cheap
+
+
+def generation_config(model_path, config):
+    from transformers import GenerationConfig
+
+    try:
+        return GenerationConfig.from_pretrained(model_path)
+    except OSError:
+        return GenerationConfig.from_model_config(config)
+
+
+def quantize(model):
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def export_int8(model_path=MODEL_PATH, export_path=EXPORT_PATH):
+    from transformers import AutoModelForSeq2SeqLM
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_path).eval()
+    path = os.path.join(export_path, "int8")
+    os.makedirs(path, exist_ok=True)
+    torch.save(quantize(model).state_dict(), os.path.join(path, "model.pt"))
+    return path
+
+
+def load_int8(model_path=MODEL_PATH, export_path=EXPORT_PATH):
+    from transformers import AutoConfig, AutoModelForSeq2SeqLM
+
+    config = AutoConfig.from_pretrained(model_path)
+    # same module structure as the export, then the quantized weights
+    model = quantize(AutoModelForSeq2SeqLM.from_config(config).eval())
+    # packed quantized weights are not plain tensors, so this needs the full unpickler (it is our own export)
+    model.load_state_dict(torch.load(os.path.join(export_path, "int8", "model.pt"), weights_only=False))
+    model.generation_config = generation_config(model_path, config)
+    return model
+
+
+class Encoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+
+class Decoder(torch.nn.Module):
+    """
+    Logits of the next token after `decoder_input_ids` (no key/value cache: the whole prefix is run every step).
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, attention_mask):
+        from transformers.modeling_outputs import BaseModelOutput
+
+        outputs = self.model(
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_hidden_states), attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids, use_cache=False,
+        )
+        return outputs.logits[:, -1]
+
+
+def export_onnx(model_path=MODEL_PATH, export_path=EXPORT_PATH, opset=17):
+    from transformers import AutoModelForSeq2SeqLM
+
+    # eager attention traces to plain ops
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_path, attn_implementation="eager").eval()
+    path = os.path.join(export_path, "onnx")
+    os.makedirs(path, exist_ok=True)
+
+    input_ids = torch.tensor([[5, 6, 7, 1], [5, 6, 1, 0]])
+    attention_mask = (input_ids != model.config.pad_token_id).long()
+    decoder_input_ids = torch.full((2, 2), model.config.decoder_start_token_id)
+    # the exporter restores the wrappers' training flag afterwards, which has to be eval too
+    encoder, decoder = Encoder(model).eval(), Decoder(model).eval()
+    with torch.no_grad():
+        hidden = encoder(input_ids, attention_mask)
+
+    batch_and_source = {0: "batch", 1: "source"}
+    torch.onnx.export(
+        encoder, (input_ids, attention_mask), os.path.join(path, "encoder.onnx"),
+        input_names=["input_ids", "attention_mask"], output_names=["encoder_hidden_states"],
+        dynamic_axes={"input_ids": batch_and_source, "attention_mask": batch_and_source, "encoder_hidden_states": batch_and_source},
+        opset_version=opset, dynamo=False,
+    )
+    torch.onnx.export(
+        decoder, (decoder_input_ids, hidden, attention_mask), os.path.join(path, "decoder.onnx"),
+        input_names=["decoder_input_ids", "encoder_hidden_states", "attention_mask"], output_names=["logits"],
+        dynamic_axes={
+            "decoder_input_ids": {0: "batch", 1: "target"}, "encoder_hidden_states": batch_and_source,
+            "attention_mask": batch_and_source, "logits": {0: "batch"},
+        },
+        opset_version=opset, dynamo=False,
+    )
+    return path
+
+
+class OnnxSeq2Seq:
+    """
+    ONNX Runtime encoder / decoder pair behind the model interface `decode` uses.
+    The "key/value cache" is the decoded prefix itself, since the exported decoder re-runs it every step
+    (names are a handful of tokens).
+    """
+
+    training = False
+
+    def __init__(self, model_path=MODEL_PATH, export_path=EXPORT_PATH):
+        import onnxruntime
+        from transformers import AutoConfig
+
+        self.config = AutoConfig.from_pretrained(model_path)
+        self.generation_config = generation_config(model_path, self.config)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        path = os.path.join(export_path, "onnx")
+        self.encoder = onnxruntime.InferenceSession(os.path.join(path, "encoder.onnx"), options, providers=["CPUExecutionProvider"])
+        self.decoder = onnxruntime.InferenceSession(os.path.join(path, "decoder.onnx"), options, providers=["CPUExecutionProvider"])
+
+    def eval(self):
+        return self
+
+    def get_encoder(self):
+        return self.encode
+
+    def encode(self, input_ids, attention_mask):
+        from transformers.modeling_outputs import BaseModelOutput
+
+        hidden = self.encoder.run(None, {"input_ids": input_ids.numpy(), "attention_mask": attention_mask.numpy()})[0]
+        return BaseModelOutput(last_hidden_state=torch.from_numpy(hidden))
+
+    def __call__(self, encoder_outputs, attention_mask, decoder_input_ids, past_key_values=None, use_cache=True):
+        from transformers.modeling_outputs import Seq2SeqLMOutput
+
+        prefix = decoder_input_ids if past_key_values is None else torch.cat((past_key_values, decoder_input_ids), dim=1)
+        logits = self.decoder.run(None, {
+            "decoder_input_ids": prefix.numpy(),
+            "encoder_hidden_states": encoder_outputs.last_hidden_state.numpy(),
+            "attention_mask": attention_mask.numpy(),
+        })[0]
+        return Seq2SeqLMOutput(logits=torch.from_numpy(logits).unsqueeze(1), past_key_values=prefix)
+
+    def _reorder_cache(self, past_key_values, beam_idx):
+        return past_key_values[beam_idx]
+
+
+def load_model(backend="torch", model_path=MODEL_PATH, export_path=EXPORT_PATH):
+    if backend == "torch":
+        from transformers import AutoModelForSeq2SeqLM
+
+        return AutoModelForSeq2SeqLM.from_pretrained(model_path)
+    if backend == "int8":
+        return load_int8(model_path, export_path)
+    if backend == "onnx":
+        return OnnxSeq2Seq(model_path, export_path)
+    raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-path", default=MODEL_PATH)
+    parser.add_argument("--export-path", default=EXPORT_PATH)
+    parser.add_argument("--int8", action="store_true", help="export a dynamically int8-quantized PyTorch model")
+    parser.add_argument("--onnx", action="store_true", help="export an ONNX encoder / decoder pair")
+    args = parser.parse_args()
+
+    if not (args.int8 or args.onnx):
+        parser.error("nothing to export, pass --int8 and/or --onnx")
+    if args.int8:
+        print(f"int8 model saved to {export_int8(args.model_path, args.export_path)}")
+    if args.onnx:
+        print(f"ONNX encoder / decoder saved to {export_onnx(args.model_path, args.export_path)}")
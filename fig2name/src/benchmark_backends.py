@@ -0,0 +1,119 @@
+"""
+Compare the inference backends (see backends.py) on a held-out set of records in the data/processed format
+({"el", "value", "name_t"}): model size on disk, resident memory, per-layer latency, exact-match accuracy
+against name_t and agreement with the fp32 names.
+
+    python backends.py --int8 --onnx
+    python benchmark_backends.py --data ../data/processed/test.json
+"""
+
+import os
+import gc
+import time
+import argparse
+from functools import partial
+from itertools import islice
+import torch
+from backends import BACKENDS, MODEL_PATH, EXPORT_PATH, load_model
+from predict_layer_names import rename_texts, load_tokenizer
+from records import format_record
+from jsonl_shards import read_records
+
+FILES = {
+    "torch": (MODEL_PATH, ["model.safetensors", "pytorch_model.bin"]),
+    "int8": (os.path.join(EXPORT_PATH, "int8"), ["model.pt"]),
+    "onnx": (os.path.join(EXPORT_PATH, "onnx"), ["encoder.onnx", "decoder.onnx"]),
+}
+
+
+def resident_memory():
+    """
+    Resident set size of this process in bytes.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def size_on_disk(backend):
+    path, names = FILES[backend]
+    return sum(os.path.getsize(os.path.join(path, name)) for name in names if os.path.exists(os.path.join(path, name)))
+
+
+def benchmark(load, texts, batch_size, single, tokenizer=None):
+    """
+    Memory, latency and names of the model returned by `load()` on `texts`.
+    The tokenizer (by default the checkpoint's) is loaded before measuring, so only the model counts towards the memory.
+    """
+    tokenizer = tokenizer or load_tokenizer()
+    # an unmeasured first load, so the code it imports (transformers model classes, onnxruntime)
+    # and one-time allocations are not counted as the model's memory
+    rename_texts(texts[:batch_size], batch_size, load(), tokenizer)
+    gc.collect()
+    before = resident_memory()
+    model = load()
+    # a first batch warms up allocations and kernels, and counts towards the memory
+    rename_texts(texts[:batch_size], batch_size, model, tokenizer)
+    memory = resident_memory() - before
+
+    start = time.perf_counter()
+    for text in texts[:single]:
+        rename_texts([text], 1, model, tokenizer)
+    single_latency = (time.perf_counter() - start) / max(1, min(single, len(texts)))
+
+    start = time.perf_counter()
+    results = rename_texts(texts, batch_size, model, tokenizer)
+    batched_latency = (time.perf_counter() - start) / len(texts)
+
+    del model
+    return {
+        "memory": memory,
+        "single_ms": single_latency * 1000,
+        "batched_ms": batched_latency * 1000,
+        "names": [name for name, _ in results],
+    }
+
+
+def print_results(results, targets, reference, agreement_label):
+    """
+    Table of `benchmark` results (with their "size" on disk): accuracy against `targets`
+    and agreement with the names of `results[reference]`.
+    """
+    names = results[reference]["names"]
+    print(f"{len(targets)} held-out layers")
+    print(f"{'':<8}{'size MB':>10}{'RSS MB':>10}{'1 layer ms':>12}{'batched ms':>12}{'accuracy':>10}{agreement_label:>12}")
+    for label, r in results.items():
+        accuracy = sum(name == target for name, target in zip(r["names"], targets)) / len(targets)
+        agreement = sum(name == ref for name, ref in zip(r["names"], names)) / len(targets)
+        print(f"{label:<8}{r['size'] / 2**20:>10.1f}{r['memory'] / 2**20:>10.1f}{r['single_ms']:>12.2f}"
+              f"{r['batched_ms']:>12.2f}{accuracy:>10.1%}{agreement:>12.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=os.path.join(os.path.dirname(__file__), "../data/processed/test.json"),
+                        help="held-out records (not used for training)")
+    parser.add_argument("--limit", type=int, default=1000, help="number of records to use")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--single", type=int, default=100, help="number of records renamed one at a time")
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    records = list(islice(read_records(args.data), args.limit))
+    texts = [format_record(record) for record in records]
+    targets = [record["name_t"] for record in records]
+
+    # fp32 is the reference the other backends are compared to
+    backends = ["torch"] + [backend for backend in args.backends if backend != "torch"]
+    results = {}
+    for backend in backends:
+        if backend != "torch" and not size_on_disk(backend):
+            print(f"{backend}: not exported, skipped (python backends.py --{backend})")
+            continue
+        results[backend] = benchmark(partial(load_model, backend), texts, args.batch_size, args.single)
+        results[backend]["size"] = size_on_disk(backend)
+
+    print_results(results, targets, "torch", "vs fp32")
@@ -0,0 +1,86 @@
+"""
+fig2name command line:
+
+    python cli.py train --data ../data/processed/train.json
+    python cli.py predict layers.json            # a JSON layer (properties dict) or a list of them, - for stdin
+    python cli.py export --int8 --onnx
+
+Commands import torch / transformers / lightning only when they run, so --help is instant.
+"""
+
+import json
+import click
+
+BACKENDS = ("torch", "int8", "onnx")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--data", default=None, help="train.json array or sharded JSONL (default: data/processed/train.json)")
+@click.option("--tokenizer", default=None, help="tokenizer trained with domain_tokenizer.py (default: the stock t5 one)")
+@click.option("--output", default=None, help="where to save the model (default: data/models)")
+@click.option("--epochs", type=click.INT, default=10)
+@click.option("--batch-size", type=click.INT, default=8)
+@click.option("--workers", type=click.INT, default=0, help="DataLoader workers")
+def train(data, tokenizer, output, epochs, batch_size, workers):
+    """Fine-tune the renamer."""
+    import train as training
+
+    path = training.train(
+        data or training.TRAIN_FILE, tokenizer or training.TOKENIZER_PATH, output or training.MODEL_PATH,
+        epochs, batch_size, workers,
+    )
+    click.echo(f"Model saved to {path}")
+
+
+@cli.command()
+@click.argument("layers", type=click.File("r"), default="-")
+@click.option("--model", "model_path", default=None, help="checkpoint directory (default: data/models or FIG2NAME_MODEL)")
+@click.option("--backend", type=click.Choice(BACKENDS), default=None, help="default: FIG2NAME_BACKEND or torch")
+@click.option("--num-beams", type=click.INT, default=1)
+@click.option("--batch-size", type=click.INT, default=32)
+@click.option("--cache", is_flag=True, default=False, help="use the persistent prediction cache")
+def predict(layers, model_path, backend, num_beams, batch_size, cache):
+    """Name the layers in LAYERS, a JSON layer or list of layers (- for stdin)."""
+    import predict_layer_names
+
+    model_path = model_path or predict_layer_names.MODEL_PATH
+    backend = backend or predict_layer_names.BACKEND
+    layers = json.load(layers)
+    if isinstance(layers, dict):
+        layers = [layers]
+
+    predict_layer_names.load(backend, model_path)
+    prediction_cache = predict_layer_names.load_cache(model_path=model_path, backend=backend) if cache else None
+    for name, confidence in predict_layer_names.rename_layers(layers, batch_size, num_beams=num_beams, cache=prediction_cache):
+        click.echo(json.dumps({"name": name, "confidence": confidence}))
+    if prediction_cache is not None:
+        click.echo(prediction_cache.summary(), err=True)
+        prediction_cache.close()
+
+
+@cli.command()
+@click.option("--model", "model_path", default=None, help="checkpoint directory (default: data/models or FIG2NAME_MODEL)")
+@click.option("--output", default=None, help="export directory (default: data/exports)")
+@click.option("--int8", is_flag=True, default=False, help="dynamically int8-quantized PyTorch model")
+@click.option("--onnx", is_flag=True, default=False, help="ONNX encoder / decoder pair")
+def export(model_path, output, int8, onnx):
+    """Export the model for the int8 / onnx inference backends."""
+    if not (int8 or onnx):
+        raise click.UsageError("nothing to export, pass --int8 and/or --onnx")
+    import backends
+
+    model_path = model_path or backends.MODEL_PATH
+    output = output or backends.EXPORT_PATH
+    if int8:
+        click.echo(f"int8 model saved to {backends.export_int8(model_path, output)}")
+    if onnx:
+        click.echo(f"ONNX encoder / decoder saved to {backends.export_onnx(model_path, output)}")
+
+
+if __name__ == "__main__":
+    cli()
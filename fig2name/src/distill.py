@@ -0,0 +1,157 @@
+"""
+Distil the layer renamer into a much smaller seq2seq student with the same tokenizer. The student is a regular
+checkpoint, so it works with everything that takes one: rename_layers / get_name_and_confidence (model=student),
+the int8 / ONNX exports, and the server (FIG2NAME_MODEL=../data/student).
+
+The student learns the teacher's greedy names (sequence-level distillation) and the teacher's token
+distributions along them (KL divergence at `temperature`), weighted by `alpha`.
+
+    python distill.py train --data ../data/processed/train.json
+    python distill.py benchmark --data ../data/processed/test.json
+"""
+
+import os
+import argparse
+from functools import partial
+from itertools import islice
+import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM
+from backends import load_model
+from predict_layer_names import decode
+from records import format_record
+from jsonl_shards import read_records
+
+TEACHER_PATH = os.path.join(os.path.dirname(__file__), "../data/models")
+STUDENT_PATH = os.path.join(os.path.dirname(__file__), "../data/student")
+# 5.0M parameters with the t5 vocabulary, about 1/12 of t5-small (60.5M); the 32k x 128 embedding is most of it,
+# with a 4k domain tokenizer (domain_tokenizer.py) it is 1.4M, about 1/42
+STUDENT_SIZE = {"d_model": 128, "d_ff": 512, "d_kv": 32, "num_heads": 4, "num_layers": 2, "num_decoder_layers": 2}
+
+
+def make_student(teacher, **size):
+    config = AutoConfig.for_model(**{**teacher.config.to_dict(), **STUDENT_SIZE, **size})
+    student = AutoModelForSeq2SeqLM.from_config(config)
+    student.generation_config = teacher.generation_config
+    return student
+
+
+def teacher_names(teacher, tokenizer, encoded, batch_size=64):
+    """
+    The teacher's greedy name of every input (token ids up to and including EOS).
+    """
+    teacher.eval()
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+    names = [None] * len(encoded)
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            inputs = tokenizer.pad({"input_ids": [encoded[i] for i in batch]}, return_tensors="pt")
+            tokens, _ = decode(teacher, inputs["input_ids"], inputs["attention_mask"])
+            for i, ids in zip(batch, tokens.tolist()):
+                eos = ids.index(teacher.config.eos_token_id) + 1 if teacher.config.eos_token_id in ids else len(ids)
+                names[i] = ids[:eos]
+    return names
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature=2.0, alpha=0.5):
+    mask = labels != -100
+    student_logits, teacher_logits = student_logits[mask], teacher_logits[mask]
+    ce = F.cross_entropy(student_logits, labels[mask])
+    kl = F.kl_div(F.log_softmax(student_logits / temperature, dim=-1), F.log_softmax(teacher_logits / temperature, dim=-1),
+                  log_target=True, reduction="batchmean")
+    return alpha * ce + (1 - alpha) * kl * temperature ** 2
+
+
+def distill(teacher, tokenizer, records, epochs=10, batch_size=64, lr=1e-3, temperature=2.0, alpha=0.5,
+            max_input_length=128, seed=0, **size):
+    """
+    Train a student of `STUDENT_SIZE` (overridden by `size`) on the teacher's names for `records`.
+    """
+    torch.manual_seed(seed)
+    encoded = tokenizer([format_record(record) for record in records], max_length=max_input_length, truncation=True)["input_ids"]
+    # labeled once, the teacher only re-runs teacher-forced (one pass) for its distributions
+    targets = teacher_names(teacher, tokenizer, encoded, batch_size)
+    student = make_student(teacher, **size)
+    print(f"student: {sum(p.numel() for p in student.parameters()):,} parameters, "
+          f"teacher: {sum(p.numel() for p in teacher.parameters()):,}")
+
+    optimizer = torch.optim.AdamW(student.parameters(), lr=lr)
+    student.train()
+    for epoch in range(epochs):
+        total, batches = 0.0, 0
+        for batch in torch.randperm(len(encoded)).split(batch_size):
+            batch = batch.tolist()
+            inputs = tokenizer.pad({"input_ids": [encoded[i] for i in batch]}, return_tensors="pt")
+            labels = pad_sequence([torch.tensor(targets[i]) for i in batch], batch_first=True, padding_value=-100)
+            with torch.no_grad():
+                teacher_logits = teacher(**inputs, labels=labels).logits
+            student_logits = student(**inputs, labels=labels).logits
+            loss = distillation_loss(student_logits, teacher_logits, labels, temperature, alpha)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item()
+            batches += 1
+        print(f"epoch {epoch + 1}/{epochs}: loss {total / batches:.4f}")
+    return student.eval()
+
+
+def size_on_disk(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+               if name.endswith((".safetensors", ".bin")))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train = commands.add_parser("train", help="distil the teacher into a student")
+    train.add_argument("--data", default=os.path.join(os.path.dirname(__file__), "../data/processed/train.json"))
+    train.add_argument("--teacher", default=TEACHER_PATH)
+    train.add_argument("--output", default=STUDENT_PATH)
+    train.add_argument("--limit", type=int, default=None, help="distil on the first LIMIT records only")
+    train.add_argument("--epochs", type=int, default=10)
+    train.add_argument("--batch-size", type=int, default=64)
+    train.add_argument("--lr", type=float, default=1e-3)
+    train.add_argument("--temperature", type=float, default=2.0)
+    train.add_argument("--alpha", type=float, default=0.5, help="weight of the hard-label loss against the KL term")
+    train.add_argument("--d-model", type=int, default=STUDENT_SIZE["d_model"])
+    train.add_argument("--layers", type=int, default=STUDENT_SIZE["num_layers"], help="encoder and decoder layers")
+
+    compare = commands.add_parser("benchmark", help="latency, memory and agreement of the student with the teacher")
+    compare.add_argument("--data", default=os.path.join(os.path.dirname(__file__), "../data/processed/test.json"),
+                         help="held-out records")
+    compare.add_argument("--teacher", default=TEACHER_PATH)
+    compare.add_argument("--student", default=STUDENT_PATH)
+    compare.add_argument("--limit", type=int, default=1000)
+    compare.add_argument("--batch-size", type=int, default=32)
+    compare.add_argument("--single", type=int, default=100, help="number of records renamed one at a time")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        tokenizer = AutoTokenizer.from_pretrained(args.teacher)
+        teacher = AutoModelForSeq2SeqLM.from_pretrained(args.teacher)
+        records = list(islice(read_records(args.data), args.limit))
+        student = distill(
+            teacher, tokenizer, records, args.epochs, args.batch_size, args.lr, args.temperature, args.alpha,
+            d_model=args.d_model, num_layers=args.layers, num_decoder_layers=args.layers,
+        )
+        student.save_pretrained(args.output)
+        tokenizer.save_pretrained(args.output)
+        print(f"student saved to {args.output}")
+    else:
+        from benchmark_backends import benchmark, print_results
+
+        torch.set_grad_enabled(False)
+        records = list(islice(read_records(args.data), args.limit))
+        texts = [format_record(record) for record in records]
+        # the student keeps the teacher's tokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.teacher)
+        results = {}
+        for label, path in (("teacher", args.teacher), ("student", args.student)):
+            results[label] = benchmark(partial(load_model, "torch", path), texts, args.batch_size, args.single, tokenizer)
+            results[label]["size"] = size_on_disk(path)
+        print_results(results, [record["name_t"] for record in records], "teacher", "vs teacher")
@@ -0,0 +1,180 @@
+"""
+Compact byte-level BPE tokenizer for layer properties and names, trained on our own records.
+The stock t5 sentencepiece vocabulary splits property strings like `EL: div VALUE: "width": "1px"` into many
+fragments; here quoted CSS property names (with their colon), numbers, units, hex colors and name parts are kept
+as whole pre-tokens, so the frequent ones become single tokens.
+Special tokens keep the t5 ids (<pad> 0, </s> 1, <unk> 2), so the model config stays valid after
+`resize_embeddings`.
+
+    python domain_tokenizer.py train --data ../data/processed/train.json --vocab-size 4000
+    python domain_tokenizer.py report --data ../data/processed/test.json
+"""
+
+import os
+import time
+import argparse
+import torch
+from tokenizers import Tokenizer, Regex, models, pre_tokenizers, decoders, processors, trainers
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM, PreTrainedTokenizerFast
+from records import format_record
+from jsonl_shards import read_records
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), "../data/models")
+TOKENIZER_PATH = os.path.join(os.path.dirname(__file__), "../data/tokenizer")
+SPECIAL_TOKENS = ["<pad>", "</s>", "<unk>"]
+# quoted property names with their colon, hex colors, numbers, letter runs (units, element types, names)
+# and runs of other punctuation, each with the space before it
+PRE_TOKEN = r'\s?"[A-Za-z-]+":|\s?#[0-9A-Fa-f]{3,8}\b|\s?\d+(?:\.\d+)?|\s?[A-Za-z]+|\s?[^\sA-Za-z\d#]+|#|\s+'
+
+
+def texts(records):
+    # inputs and names share the vocabulary (t5 ties the encoder and decoder embeddings)
+    for record in records:
+        yield format_record(record)
+        yield record['name_t']
+
+
+def train_tokenizer(records, vocab_size=4000, min_frequency=2):
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([
+        pre_tokenizers.Split(Regex(PRE_TOKEN), behavior="isolated"),
+        pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=False),
+    ])
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="$A </s>", pair="$A </s> $B </s>", special_tokens=[("</s>", SPECIAL_TOKENS.index("</s>"))])
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size, min_frequency=min_frequency, special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False)
+    tokenizer.train_from_iterator(texts(records), trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", eos_token="</s>", unk_token="<unk>")
+
+
+def remap_rows(weight, rows):
+    """
+    New weight matrix whose row i is the mean of `weight[rows[i]]` (random, at the scale of `weight`, if `rows[i]` is empty).
+    """
+    new = weight.new_empty(len(rows), weight.size(1)).normal_(std=weight.std().item())
+    for i, ids in enumerate(rows):
+        if ids:
+            new[i] = weight[ids].mean(0)
+    return new
+
+
+def resize_embeddings(model, old_tokenizer, new_tokenizer):
+    """
+    Resize the model to `new_tokenizer`'s vocabulary. Every new token starts from the mean of the embeddings
+    (and output rows) of the pieces `old_tokenizer` splits it into, so the pretrained weights stay useful.
+    """
+    vocab = sorted(new_tokenizer.get_vocab().items(), key=lambda item: item[1])
+    specials = set(new_tokenizer.all_special_tokens)
+    rows = []
+    for token, _ in vocab:
+        if token in specials:
+            rows.append([old_tokenizer.convert_tokens_to_ids(token)])
+        else:
+            rows.append(old_tokenizer(new_tokenizer.convert_tokens_to_string([token]), add_special_tokens=False)["input_ids"])
+
+    with torch.no_grad():
+        embeddings = remap_rows(model.get_input_embeddings().weight, rows)
+        output = model.get_output_embeddings()
+        tied = output is None or output.weight is model.get_input_embeddings().weight
+        output_weight = None if tied else remap_rows(output.weight, rows)
+
+        model.resize_token_embeddings(len(vocab), mean_resizing=False)
+        model.get_input_embeddings().weight.copy_(embeddings)
+        if output_weight is not None:
+            model.get_output_embeddings().weight.copy_(output_weight)
+    return model
+
+
+def lengths(tokenizer, strings):
+    return [len(ids) for ids in tokenizer(strings)["input_ids"]]
+
+
+def time_steps(config, tokenizer, inputs, targets, batch_size, steps):
+    """
+    Seconds per sample of a training step (forward + backward) and of a forward pass without gradients,
+    for a freshly initialized model of `config` with `tokenizer`'s vocabulary.
+    """
+    config = AutoConfig.for_model(**{**config.to_dict(), "vocab_size": len(tokenizer)})
+    model = AutoModelForSeq2SeqLM.from_config(config)
+    batches = []
+    for start in range(0, min(len(inputs), batch_size * steps), batch_size):
+        x = tokenizer(inputs[start:start + batch_size], padding=True, return_tensors="pt")
+        y = tokenizer(targets[start:start + batch_size], padding=True, return_tensors="pt")["input_ids"]
+        batches.append((x["input_ids"], x["attention_mask"], y.masked_fill(y == tokenizer.pad_token_id, -100)))
+    samples = sum(len(batch[0]) for batch in batches)
+
+    model.train()
+    start = time.perf_counter()
+    for input_ids, attention_mask, labels in batches:
+        model(input_ids=input_ids, attention_mask=attention_mask, labels=labels).loss.backward()
+    train = (time.perf_counter() - start) / samples
+
+    model.eval()
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for input_ids, attention_mask, labels in batches:
+            model(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
+    inference = (time.perf_counter() - start) / samples
+    return train, inference
+
+
+def report(records, base, domain, config, batch_size=32, steps=20):
+    inputs = [format_record(record) for record in records]
+    targets = [record['name_t'] for record in records]
+    rows = {}
+    for name, tokenizer in (("base", base), ("domain", domain)):
+        input_lengths, target_lengths = lengths(tokenizer, inputs), lengths(tokenizer, targets)
+        rows[name] = {
+            "vocab": len(tokenizer),
+            "input": sum(input_lengths) / len(inputs),
+            "max_input": max(input_lengths),
+            "target": sum(target_lengths) / len(targets),
+            "timing": time_steps(config, tokenizer, inputs, targets, batch_size, steps),
+        }
+
+    print(f"{len(records)} held-out records, timings with batches of {batch_size} on a {config.model_type} of the checkpoint's size")
+    print(f"{'':<8}{'vocab':>8}{'input':>8}{'max':>6}{'name':>7}{'train ms':>10}{'forward ms':>12}")
+    for name, r in rows.items():
+        print(f"{name:<8}{r['vocab']:>8}{r['input']:>8.1f}{r['max_input']:>6}{r['target']:>7.1f}"
+              f"{r['timing'][0] * 1000:>10.2f}{r['timing'][1] * 1000:>12.2f}")
+    base, domain = rows["base"], rows["domain"]
+    print(f"input length -{1 - domain['input'] / base['input']:.0%}, name length -{1 - domain['target'] / base['target']:.0%}, "
+          f"training {base['timing'][0] / domain['timing'][0]:.2f}x, forward {base['timing'][1] / domain['timing'][1]:.2f}x "
+          f"(decoding steps also drop with the name length)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train = commands.add_parser("train", help="train the tokenizer on a record file or JSONL shards")
+    train.add_argument("--data", default=os.path.join(os.path.dirname(__file__), "../data/processed/train.json"))
+    train.add_argument("--vocab-size", type=int, default=4000)
+    train.add_argument("--min-frequency", type=int, default=2)
+    train.add_argument("--output", default=TOKENIZER_PATH)
+
+    compare = commands.add_parser("report", help="sequence lengths and step times against the base tokenizer")
+    compare.add_argument("--data", default=os.path.join(os.path.dirname(__file__), "../data/processed/test.json"),
+                         help="held-out records")
+    compare.add_argument("--tokenizer", default=TOKENIZER_PATH)
+    compare.add_argument("--base", default=MODEL_PATH, help="tokenizer (and model config) to compare against")
+    compare.add_argument("--limit", type=int, default=2000)
+    compare.add_argument("--batch-size", type=int, default=32)
+    compare.add_argument("--steps", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "train":
+        tokenizer = train_tokenizer(read_records(args.data), args.vocab_size, args.min_frequency)
+        tokenizer.save_pretrained(args.output)
+        print(f"{len(tokenizer)} token vocabulary saved to {args.output}")
+    else:
+        records = []
+        for record in read_records(args.data):
+            records.append(record)
+            if len(records) == args.limit:
+                break
+        report(records, AutoTokenizer.from_pretrained(args.base), AutoTokenizer.from_pretrained(args.tokenizer),
+               AutoConfig.from_pretrained(args.base), args.batch_size, args.steps)
@@ -0,0 +1,121 @@
+"""
+Training records as sharded JSONL: one record ({"el", "value", "name_t"}) per line, in any number of
+*.jsonl, *.jsonl.gz or *.jsonl.zst files (zstd needs the `zstandard` package).
+"""
+
+import io
+import os
+import glob
+import gzip
+import json
+
+SUFFIXES = (".jsonl", ".jsonl.gz", ".jsonl.zst")
+
+
+def is_jsonl(path):
+    return os.path.isdir(path) or glob.has_magic(path) or str(path).endswith(SUFFIXES)
+
+
+def shard_paths(path):
+    """
+    Sorted shard files of a directory, a glob pattern or a single shard.
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path) if name.endswith(SUFFIXES)]
+    elif glob.has_magic(path):
+        paths = glob.glob(path)
+    else:
+        paths = [path]
+    if not paths:
+        raise FileNotFoundError(f"no {', '.join(SUFFIXES)} shards in {path}")
+    return sorted(paths)
+
+
+def open_shard(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f"reading {path} needs the zstandard package (pip install zstandard)") from None
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True), encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def iter_records(paths, skip=0, step=1):
+    """
+    Records of the shards in order, keeping every `step`-th record starting at `skip` (over all the shards).
+    """
+    i = 0
+    for path in paths:
+        with open_shard(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if i % step == skip:
+                    yield json.loads(line)
+                i += 1
+
+
+def read_records(path):
+    """
+    Records of sharded JSONL or of a train.json array.
+    """
+    if is_jsonl(path):
+        yield from iter_records(shard_paths(path))
+    else:
+        with open(path) as f:
+            yield from json.load(f)
+
+
+def shuffled(items, buffer_size, rng):
+    """
+    Approximate shuffle of a stream with a bounded buffer: each item is swapped into a random slot of a
+    `buffer_size` reservoir and the item it replaces comes out. Memory is `buffer_size` items whatever the stream length.
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def write_shards(records, path, shard_size=100_000, compress=True):
+    """
+    Split records (e.g. an old monolithic train.json) into JSONL shards of `shard_size` records in the directory `path`.
+    """
+    os.makedirs(path, exist_ok=True)
+    suffix = ".jsonl.gz" if compress else ".jsonl"
+    f, count = None, 0
+    for count, record in enumerate(records):
+        if count % shard_size == 0:
+            if f is not None:
+                f.close()
+            name = os.path.join(path, f"shard-{count // shard_size:05d}{suffix}")
+            f = gzip.open(name, "wt", encoding="utf-8") if compress else open(name, "w", encoding="utf-8")
+        f.write(json.dumps(record) + "\n")
+    if f is not None:
+        f.close()
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Split a train.json array into gzipped JSONL shards")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--shard-size", type=int, default=100_000)
+    parser.add_argument("--no-compress", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.input) as f:
+        records = json.load(f)
+    print(f"{write_shards(records, args.output, args.shard_size, not args.no_compress)} records written to {args.output}")
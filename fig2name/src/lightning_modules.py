@@ -0,0 +1,71 @@
+"""
+The PyTorch Lightning side of training (imported by train.py only when training runs).
+"""
+
+from functools import partial
+import torch
+from torch.utils.data import IterableDataset, DataLoader
+from transformers import AutoModelForSeq2SeqLM
+import pytorch_lightning as pl
+from train import FigmaDataset, StreamingFigmaDataset, pad_collate
+from jsonl_shards import is_jsonl
+
+
+# Model
+
+
+class FigmaLayerRenamer(pl.LightningModule):
+    def __init__(self, model_name):
+        super().__init__()
+        self.seq2seq = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+
+    def forward(self, input_ids, target_ids=None, attention_mask=None):
+        if target_ids is not None:
+            outputs = self.seq2seq(input_ids=input_ids, attention_mask=attention_mask, labels=target_ids)
+            return outputs.loss
+        else:
+            predicted_ids = self.seq2seq.generate(input_ids=input_ids, attention_mask=attention_mask)
+            return predicted_ids
+
+    def training_step(self, batch, batch_idx):
+        input_ids, attention_mask, target_ids = batch
+        loss = self(input_ids, target_ids, attention_mask)
+        self.log("train_loss", loss)
+        return loss
+
+    def configure_optimizers(self):
+        optimizer = torch.optim.Adam(self.parameters(), lr=5e-5)
+        return optimizer
+
+
+# DataModule
+class FigmaDataModule(pl.LightningDataModule):
+    """
+    `train_file` is either a train.json array (pre-tokenized into a cache) or sharded JSONL
+    (a directory, a glob pattern or a single .jsonl[.gz|.zst] file), which is streamed.
+    """
+
+    def __init__(self, train_file, tokenizer, batch_size=8, num_workers=0):
+        super().__init__()
+        self.train_file = train_file
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+    def prepare_data(self):
+        # runs in one process per node, before `setup` on every rank: the only place the token cache is written
+        if not is_jsonl(self.train_file):
+            FigmaDataset(self.train_file, self.tokenizer)
+
+    def setup(self, stage=None):
+        if is_jsonl(self.train_file):
+            self.train_dataset = StreamingFigmaDataset(self.train_file, self.tokenizer)
+        else:
+            self.train_dataset = FigmaDataset(self.train_file, self.tokenizer, build_cache=False)
+
+    def train_dataloader(self):
+        collate = partial(pad_collate, pad_token_id=self.tokenizer.pad_token_id)
+        # a streamed dataset shuffles itself
+        shuffle = not isinstance(self.train_dataset, IterableDataset)
+        return DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=shuffle, collate_fn=collate,
+                          num_workers=self.num_workers, persistent_workers=self.num_workers > 0)
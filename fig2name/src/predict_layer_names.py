@@ -1,53 +1,195 @@
 import os
 import json
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 import torch.nn.functional as F
 import torch
+from prediction_cache import PredictionCache, checkpoint_id
+from backends import MODEL_PATH, load_model
 
 
-MODEL_PATH = os.path.join(os.path.dirname(__file__), "../data/models")
-tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
-model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_PATH)
+CACHE_PATH = os.path.join(os.path.dirname(__file__), "../data/cache/predictions.sqlite")
+# torch (fp32), int8 or onnx, see backends.py (the int8 / onnx models have to be exported first)
+BACKEND = os.environ.get("FIG2NAME_BACKEND", "torch")
 
-def get_name_and_confidence(properties, model, tokenizer):
-    # Encode the input properties
 
-    # get the 'type' property
-    _el = properties['type']
-    # remove the 'type' property
-    del properties['type']
-
-    _value = json.dumps(properties).replace("{", "").replace("}", "")
+def load(backend=BACKEND, model_path=MODEL_PATH):
+    """
+    Load the module's default `model` and `tokenizer` (used when none are passed).
+    Otherwise they are loaded on first use, so importing this module is cheap.
+    """
+    global model
+    load_tokenizer(model_path)
+    model = load_model(backend, model_path)
+    return model, tokenizer
 
-    input_text = f"EL: {_el} VALUE: {_value} "
 
-    input_ids = tokenizer.encode(input_text, return_tensors="pt")
+def load_tokenizer(model_path=MODEL_PATH):
+    """
+    Load only the module's default `tokenizer` (e.g. for a model that is passed in).
+    """
+    global tokenizer
+    from transformers import AutoTokenizer
 
-    # Create an array of decoder_input_ids filled with the decoder_start_token_id
-    decoder_input_ids = torch.full(
-        (input_ids.shape[0], model.config.max_length),
-        model.config.decoder_start_token_id,
-        dtype=torch.long
-    )
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    return tokenizer
 
-    # Run the forward pass
-    outputs = model(input_ids=input_ids, decoder_input_ids=decoder_input_ids)
 
-    # Extract the logits and apply softmax
-    logits = outputs.logits
-    softmax_logits = F.softmax(logits, dim=-1)
+def __getattr__(name):
+    if name == "model":
+        return load()[0]
+    if name == "tokenizer":
+        return load_tokenizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    # Get the predicted token ids and confidence
-    predicted_token_ids = torch.argmax(softmax_logits, dim=-1)
-    confidence = softmax_logits.max().item()
 
-    # Decode the output sequence
-    new_name = tokenizer.decode(predicted_token_ids[0], skip_special_tokens=False)
-
-    return new_name, confidence
+def format_input(properties):
+    """
+    The model input text for a layer's properties (without modifying `properties`).
+    """
+    # get the 'type' property
+    _el = properties['type']
+    # the rest of the properties are the value
+    _value = json.dumps({k: v for k, v in properties.items() if k != 'type'}).replace("{", "").replace("}", "")
+
+    return f"EL: {_el} VALUE: {_value} "
+
+
+def max_length(model):
+    # older configs carry max_length themselves, newer ones only in the generation config
+    return getattr(model.config, "max_length", None) or model.generation_config.max_length or 20
+
+
+def reorder_cache(model, past_key_values, beam_idx):
+    # Cache objects reorder in place, older versions return reordered tuples
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(beam_idx)
+        return past_key_values
+    return model._reorder_cache(past_key_values, beam_idx)
+
+
+def decode(model, input_ids, attention_mask, num_beams=1, max_new_tokens=None):
+    """
+    Incremental decoding with a key/value cache: the encoder runs once, then the decoder one token per step,
+    until every sequence has produced EOS (or `max_new_tokens`, default `max_length(model)`).
+    num_beams=1 is greedy; more keeps the `num_beams` best partial names per input.
+    Returns the best token ids of each input (without the start token) and their log-probability (sum over the tokens).
+    """
+    batch_size = input_ids.size(0)
+    k = num_beams
+    eos, pad = model.config.eos_token_id, model.config.pad_token_id
+
+    encoder_outputs = model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask)
+    if k > 1:
+        encoder_outputs.last_hidden_state = encoder_outputs.last_hidden_state.repeat_interleave(k, dim=0)
+        attention_mask = attention_mask.repeat_interleave(k, dim=0)
+
+    tokens = torch.full((batch_size * k, 1), model.config.decoder_start_token_id, dtype=torch.long)
+    # all beams start from the same prefix: only the first one may expand at the first step
+    scores = torch.zeros(batch_size, k)
+    scores[:, 1:] = float("-inf")
+    finished = torch.zeros(batch_size * k, dtype=torch.bool)
+    past_key_values = None
+
+    for _ in range(max_new_tokens or max_length(model)):
+        outputs = model(
+            encoder_outputs=encoder_outputs, attention_mask=attention_mask,
+            decoder_input_ids=tokens[:, -1:], past_key_values=past_key_values, use_cache=True,
+        )
+        past_key_values = outputs.past_key_values
+        log_probs = F.log_softmax(outputs.logits[:, -1].float(), dim=-1)
+        # finished sequences only extend with padding, at no cost
+        log_probs[finished] = float("-inf")
+        log_probs[finished, pad] = 0
+
+        vocab_size = log_probs.size(-1)
+        candidates = (scores.view(-1, 1) + log_probs).view(batch_size, k * vocab_size)
+        scores, index = candidates.topk(k, dim=-1)
+        beam_idx = (torch.arange(batch_size).unsqueeze(1) * k + index // vocab_size).view(-1)
+        next_tokens = (index % vocab_size).view(-1, 1)
+
+        if k > 1:
+            tokens, finished = tokens[beam_idx], finished[beam_idx]
+            past_key_values = reorder_cache(model, past_key_values, beam_idx)
+        tokens = torch.cat((tokens, next_tokens), dim=1)
+        finished = finished | (next_tokens.view(-1) == eos)
+        if finished.all():
+            break
+
+    # beams are sorted by score, the first one of each input is the best
+    return tokens[::k, 1:], scores[:, 0]
+
+
+def get_name_and_confidence(properties, model, tokenizer, num_beams=1):
+    """
+    The predicted name of a layer and its confidence: the log-probability of the whole name under the model.
+    """
+    return rename_layers([properties], batch_size=1, model=model, tokenizer=tokenizer, num_beams=num_beams)[0]
+
+
+def load_cache(path=CACHE_PATH, model_path=MODEL_PATH, capacity=100_000, backend=BACKEND):
+    """
+    The persistent prediction cache for the checkpoint at `model_path`, run by `backend`
+    (quantized backends can predict slightly different names).
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    checkpoint = checkpoint_id(model_path) if backend == "torch" else f"{checkpoint_id(model_path)}-{backend}"
+    return PredictionCache(path, checkpoint, capacity=capacity)
+
+
+def rename_layers(list_of_properties, batch_size=32, model=None, tokenizer=None, num_beams=1, cache=None):
+    """
+    Batched `get_name_and_confidence` for a whole document: returns [(name, confidence)] in input order.
+    Layers are sorted by input length and each batch is padded only to its own longest input (with an attention mask),
+    so a batch costs about as much as its longest layer.
+    With a `cache` (see `load_cache`), only layers whose canonical properties were never predicted reach the model.
+    """
+    if cache is not None:
+        keys = [cache.key(properties, num_beams=num_beams) for properties in list_of_properties]
+        found = cache.get_many(keys)
+        missing = {key: properties for key, properties in zip(keys, list_of_properties) if key not in found}
+        if missing:
+            predicted = rename_layers(list(missing.values()), batch_size, model, tokenizer, num_beams)
+            new = dict(zip(missing, predicted))
+            cache.put_many(new)
+            found.update(new)
+        return [found[key] for key in keys]
+
+    return rename_texts([format_input(properties) for properties in list_of_properties], batch_size, model, tokenizer, num_beams)
+
+
+def rename_texts(texts, batch_size=32, model=None, tokenizer=None, num_beams=1):
+    """
+    `rename_layers` for already formatted model inputs (see `format_input`).
+    """
+    # a passed-in model only needs the default tokenizer, not a second copy of the default model
+    if model is None:
+        model = globals()["model"] if "model" in globals() else load()[0]
+    if tokenizer is None:
+        tokenizer = globals()["tokenizer"] if "tokenizer" in globals() else load_tokenizer()
+    if model.training:
+        model.eval()
+
+    # identical layers (the same component all over a document) are predicted once
+    unique = list(dict.fromkeys(texts))
+    encoded = tokenizer(unique)["input_ids"]
+    order = sorted(range(len(unique)), key=lambda i: len(encoded[i]))
+
+    results = [None] * len(unique)
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            inputs = tokenizer.pad({"input_ids": [encoded[i] for i in batch]}, return_tensors="pt")
+            predicted_token_ids, log_probs = decode(model, inputs["input_ids"], inputs["attention_mask"], num_beams)
+            names = tokenizer.batch_decode(predicted_token_ids, skip_special_tokens=True)
+
+            for i, name, confidence in zip(batch, names, log_probs.tolist()):
+                results[i] = (name, confidence)
+
+    results = dict(zip(unique, results))
+    return [results[text] for text in texts]
 
 
 if __name__ == "__main__":
+  model, tokenizer = load()
 
   properties = {
     "type": "div",
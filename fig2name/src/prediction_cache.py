@@ -0,0 +1,141 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+from collections import OrderedDict
+
+# "10px", "10.0 px", "10" and 10 are the same value
+NUMBER_WITH_UNIT = re.compile(r"^\s*(-?(?:\d+\.?\d*|\.\d+))\s*(px)?\s*$", re.IGNORECASE)
+HEX_COLOR = re.compile(r"^\s*#[0-9a-f]{3,8}\s*$", re.IGNORECASE)
+
+
+def canonical_value(value):
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        match = NUMBER_WITH_UNIT.match(value)
+        if match:
+            return float(match.group(1))
+        if HEX_COLOR.match(value):
+            return value.strip().lower()
+        return value.strip()
+    if isinstance(value, dict):
+        return canonicalize(value)
+    if isinstance(value, (list, tuple)):
+        return [canonical_value(v) for v in value]
+    return value
+
+
+def canonicalize(properties):
+    """
+    Canonical form of a layer's property dict: sorted keys, px units dropped and numbers as floats,
+    hex colors lowercased, surrounding whitespace stripped.
+    """
+    return {key: canonical_value(properties[key]) for key in sorted(properties)}
+
+
+def checkpoint_id(model_path):
+    """
+    Identifies a checkpoint directory by its files (names, sizes and modification times),
+    so retraining or replacing the model invalidates the cached predictions.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(os.listdir(model_path)):
+        stat = os.stat(os.path.join(model_path, name))
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """
+    (name, confidence) predictions keyed by the canonical layer properties, the checkpoint id and the decoding settings.
+    Lookups go to an in-process LRU of `capacity` entries first, then to a SQLite store at `path` that survives restarts
+    (None for memory only).
+    """
+
+    def __init__(self, path, checkpoint, capacity=100_000):
+        self.checkpoint = checkpoint
+        self.capacity = capacity
+        self.memory = OrderedDict()
+        self.hits = self.disk_hits = self.misses = 0
+
+        self.conn = None
+        if path is not None:
+            # the server runs predictions on a worker thread (one at a time)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, name TEXT, confidence REAL) WITHOUT ROWID")
+            self.conn.commit()
+
+    def key(self, properties, **settings):
+        data = json.dumps([self.checkpoint, settings, canonicalize(properties)], sort_keys=True)
+        return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """
+        {key: (name, confidence)} for the keys that are cached.
+        """
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+            else:
+                missing.append(key)
+        self.hits += len(found)
+
+        if self.conn is not None and missing:
+            # sqlite's default limit is 999 bound parameters per statement
+            for start in range(0, len(missing), 900):
+                chunk = missing[start:start + 900]
+                rows = self.conn.execute(
+                    f"SELECT key, name, confidence FROM predictions WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, name, confidence in rows:
+                    found[key] = (name, confidence)
+                    self.remember(key, (name, confidence))
+                    self.disk_hits += 1
+
+        self.misses += len(missing) - sum(key in found for key in missing)
+        return found
+
+    def put_many(self, items):
+        """
+        Store {key: (name, confidence)}, in memory and (in one transaction) on disk.
+        """
+        for key, value in items.items():
+            self.remember(key, value)
+        if self.conn is not None and items:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO predictions (key, name, confidence) VALUES (?, ?, ?)",
+                    [(key, name, confidence) for key, (name, confidence) in items.items()])
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+        }
+
+    def summary(self):
+        s = self.stats()
+        return (f"Prediction cache: {s['hits']} memory hits, {s['disk_hits']} disk hits, {s['misses']} misses "
+                f"({s['hit_rate']:.1%} hit rate)")
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,19 @@
+def format_record(record):
+    """
+    Model input text of a training record ({"el", "value", "name_t"}),
+    the same text `predict_layer_names.format_input` builds from a layer's properties.
+    """
+    el_str = f"EL: {record['el']} "
+    value_str = f"VALUE: {record['value']} " if record.get('value') else ""
+    input_features = f"{el_str}{value_str}"
+
+    # Preprocess the record into a suitable format for the model
+    # This should include tokenization, one-hot encoding, and other necessary conversions
+    # type_str = f"TYPE: {record['type']} "
+    # color_str = f"COLOR: {record['color']} " if record['color'] else ""
+    # background_str = f"BACKGROUND: {record['background']} " if record['background'] else ""
+    # text_str = f"TEXT: {record['text']} " if record.get('text') else ""
+    # child_count = len(record['children']) if record.get('children') else 0
+    # children_str = f"CHILD_COUNT: {child_count} "
+    # input_features = f"{type_str}{color_str}{background_str}{text_str}{children_str}"
+    return input_features
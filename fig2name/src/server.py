@@ -0,0 +1,211 @@
+"""
+Local rename server: one warm model behind an asyncio HTTP server (TCP or Unix socket).
+Requests are queued and run in micro-batches of up to `max_batch_size` layers, waiting at most `max_wait_ms`
+after the first queued layer for a batch to fill.
+
+POST /rename  {"layers": [properties, ...]}  ->  {"names": [[name, confidence], ...]}
+GET  /stats   ->  request latency p50 / p99, queue depth, batch sizes
+
+    python server.py --port 8765
+    curl -d '{"layers": [{"type": "div", "width": "10px"}]}' localhost:8765/rename
+"""
+
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import predict_layer_names
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class MicroBatcher:
+    """
+    Queues layers and renames them in batches on a single worker thread (the model stays warm and the event loop free).
+    """
+
+    def __init__(self, rename, max_batch_size=64, max_wait_ms=5, window=10_000):
+        self.rename = rename
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # recent request latencies (seconds) and batch sizes
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.max_queue_depth = 0
+        self.requests = 0
+
+    async def submit(self, layers):
+        """
+        Rename `layers` (a list of property dicts); resolves once every layer's batch has run.
+        """
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in layers]
+        for properties, future in zip(layers, futures):
+            self.queue.put_nowait((properties, future))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+        results = await asyncio.gather(*futures)
+        self.latencies.append(time.perf_counter() - start)
+        self.requests += 1
+        return results
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batch_sizes.append(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.rename, [properties for properties, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        latencies = list(self.latencies)
+        return {
+            "requests": self.requests,
+            "latency_p50_ms": percentile(latencies, 50) * 1000,
+            "latency_p99_ms": percentile(latencies, 99) * 1000,
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "batches": len(self.batch_sizes),
+            "mean_batch_size": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else 0.0,
+        }
+
+
+# pending connections; bursts of concurrent clients (one connection per layer) overflow the default 100
+BACKLOG = 1024
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+async def read_request(reader):
+    """
+    (method, path, headers, body) of the next HTTP/1.1 request on the connection, or None when it is closed.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {STATUS[status]}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body)
+
+
+def make_handler(batcher):
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    write_response(writer, 400, {"error": "malformed request"}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+                if path == "/stats":
+                    status, payload = 200, batcher.stats()
+                elif path != "/rename":
+                    status, payload = 404, {"error": f"no route {path}"}
+                elif method != "POST":
+                    status, payload = 405, {"error": "POST a JSON body"}
+                else:
+                    try:
+                        layers = json.loads(body)["layers"]
+                        # checked here, a bad layer would fail every request batched with it
+                        if not all(isinstance(properties, dict) and "type" in properties for properties in layers):
+                            raise ValueError("every layer needs a 'type'")
+                        status, payload = 200, {"names": await batcher.submit(layers)}
+                    except (ValueError, KeyError, TypeError) as e:
+                        status, payload = 400, {"error": f"expected {{\"layers\": [properties, ...]}}: {e}"}
+                    except Exception as e:
+                        status, payload = 500, {"error": repr(e)}
+
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            # the client went away mid-request
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(host="127.0.0.1", port=8765, unix_socket=None, max_batch_size=64, max_wait_ms=5, cache=None):
+    def rename(layers):
+        return predict_layer_names.rename_layers(layers, batch_size=max_batch_size, cache=cache)
+
+    # load the model before accepting connections, not in the first request
+    predict_layer_names.load()
+    batcher = MicroBatcher(rename, max_batch_size, max_wait_ms)
+    worker = asyncio.create_task(batcher.run())
+    if unix_socket:
+        server = await asyncio.start_unix_server(make_handler(batcher), path=unix_socket, backlog=BACKLOG)
+    else:
+        server = await asyncio.start_server(make_handler(batcher), host, port, backlog=BACKLOG)
+    print(f"Serving on {unix_socket or f'http://{host}:{port}'} (batches of up to {max_batch_size}, {max_wait_ms} ms max wait)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None, help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--cache", action="store_true", help="use the persistent prediction cache")
+    args = parser.parse_args()
+
+    asyncio.run(serve(
+        args.host, args.port, args.unix_socket, args.max_batch_size, args.max_wait_ms,
+        cache=predict_layer_names.load_cache() if args.cache else None,
+    ))
@@ -0,0 +1,160 @@
+"""
+Pre-tokenized training corpus, memory-mapped:
+
+<dir>/manifest.json
+<dir>/inputs.ids.npy       int32 (tokens,)     input ids of every record, concatenated
+<dir>/inputs.offsets.npy   int64 (count + 1,)  record i is ids[offsets[i]:offsets[i + 1]]
+<dir>/targets.ids.npy      int32 (tokens,)     target (name) ids, same layout
+<dir>/targets.offsets.npy  int64 (count + 1,)
+
+The manifest stores a fingerprint of everything the ids depend on (the records file, the tokenizer,
+the function formatting a record into the input text and the maximum lengths); `open_token_cache`
+rebuilds the cache whenever it no longer matches.
+"""
+
+import os
+import json
+import inspect
+import hashlib
+from pathlib import Path
+import numpy as np
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+ARRAYS = ("inputs.ids", "inputs.offsets", "targets.ids", "targets.offsets")
+
+
+def tokenizer_fingerprint(tokenizer):
+    # a fast tokenizer serializes completely (vocab, normalizer, pre-tokenizer, post-processor), along with
+    # the truncation / padding of its last call, which is left out: the ids are tokenized with their own max lengths
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        state = json.loads(backend.to_str())
+        state.pop("truncation", None)
+        state.pop("padding", None)
+        state = json.dumps(state, sort_keys=True)
+    else:
+        state = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    data = json.dumps([type(tokenizer).__name__, state, tokenizer.all_special_tokens])
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def function_fingerprint(function):
+    try:
+        return inspect.getsource(function)
+    except OSError:
+        # no source file (defined interactively): the bytecode and constants
+        code = function.__code__
+        return repr((code.co_code, code.co_consts, code.co_names))
+
+
+def fingerprint(records_path, tokenizer, format_record, max_input_length, max_target_length):
+    stat = os.stat(records_path)
+    data = json.dumps([
+        FORMAT_VERSION, os.path.abspath(records_path), stat.st_size, stat.st_mtime_ns,
+        tokenizer_fingerprint(tokenizer), function_fingerprint(format_record), max_input_length, max_target_length,
+    ])
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def ragged(sequences):
+    """
+    Flat int32 ids and int64 offsets of a list of id lists.
+    """
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in sequences], out=offsets[1:])
+    ids = np.fromiter((i for ids in sequences for i in ids), dtype=np.int32, count=offsets[-1])
+    return ids, offsets
+
+
+def build_token_cache(path, records, tokenizer, format_record, max_input_length, max_target_length, key, chunk_size=10_000):
+    """
+    Tokenize `records` (in chunks, with the batched tokenizer) and write the cache to `path` under the fingerprint `key`.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    # an interrupted build must not look complete
+    (path / MANIFEST).unlink(missing_ok=True)
+
+    inputs, targets = [], []
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        inputs += tokenizer([format_record(record) for record in chunk], max_length=max_input_length, truncation=True)["input_ids"]
+        targets += tokenizer([record["name_t"] for record in chunk], max_length=max_target_length, truncation=True)["input_ids"]
+
+    for name, sequences in (("inputs", inputs), ("targets", targets)):
+        ids, offsets = ragged(sequences)
+        for array_name, array in ((f"{name}.ids", ids), (f"{name}.offsets", offsets)):
+            # replaced, not rewritten in place: a reader still mapping the old file keeps its copy
+            tmp = path / f"{array_name}.tmp.npy"
+            np.save(tmp, array)
+            os.replace(tmp, path / f"{array_name}.npy")
+
+    tmp = path / f"{MANIFEST}.tmp"
+    with tmp.open("w") as f:
+        json.dump({"version": FORMAT_VERSION, "fingerprint": key, "count": len(records)}, f, indent=2)
+    os.replace(tmp, path / MANIFEST)
+
+
+def open_token_cache(path, records_path, tokenizer, format_record, max_input_length, max_target_length, build=True):
+    """
+    Make sure the cache at `path` matches the records file, tokenizer and record format (rebuilding it if not),
+    and return its manifest. With build=False a missing or stale cache raises FileNotFoundError instead
+    (for processes that must not write it, e.g. every DDP rank but the one that prepared the data).
+    """
+    path = Path(path)
+    key = fingerprint(records_path, tokenizer, format_record, max_input_length, max_target_length)
+    try:
+        with (path / MANIFEST).open() as f:
+            manifest = json.load(f)
+        if manifest["fingerprint"] == key:
+            return manifest
+    except (OSError, ValueError, KeyError):
+        pass
+    if not build:
+        raise FileNotFoundError(f"no up-to-date token cache of {records_path} in {path}")
+
+    print(f"Tokenizing {records_path} into {path}")
+    with open(records_path) as f:
+        records = json.load(f)
+    build_token_cache(path, records, tokenizer, format_record, max_input_length, max_target_length, key)
+    with (path / MANIFEST).open() as f:
+        return json.load(f)
+
+
+class TokenCache:
+    """
+    Read side of the cache: (input ids, target ids) of record i as zero-copy int32 views.
+    The files are mapped lazily, so each DataLoader worker maps them itself instead of receiving a pickled copy.
+    """
+
+    def __init__(self, path, count):
+        self.path = Path(path)
+        self.count = count
+        self._arrays = None
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {name: np.load(self.path / f"{name}.npy", mmap_mode="r") for name in ARRAYS}
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        a = self.arrays
+        inputs, targets = a["inputs.offsets"], a["targets.offsets"]
+        return (a["inputs.ids"][inputs[idx]:inputs[idx + 1]],
+                a["targets.ids"][targets[idx]:targets[idx + 1]])
+
+    def lengths(self):
+        """
+        Input length (in tokens) of every record.
+        """
+        return np.diff(self.arrays["inputs.offsets"])
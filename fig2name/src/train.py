@@ -1,117 +1,170 @@
 import os
-import json
+import random
+from itertools import islice
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.optim import Adam
-from torch.utils.data import Dataset, DataLoader
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
-import pytorch_lightning as pl
-from pytorch_lightning.callbacks import TQDMProgressBar
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from torch.nn.utils.rnn import pad_sequence
+from token_cache import TokenCache, open_token_cache
+from records import format_record
+from jsonl_shards import shard_paths, iter_records, shuffled
 
 
 # Constants
-TRAIN_FILE = os.path.join(os.path.abspath(
-    os.path.dirname(__file__)), "../data/processed/train.json")
+# a train.json array, or sharded JSONL (a directory or glob of .jsonl / .jsonl.gz / .jsonl.zst files)
+TRAIN_FILE = os.environ.get("FIG2NAME_TRAIN_FILE", os.path.join(os.path.abspath(
+    os.path.dirname(__file__)), "../data/processed/train.json"))
+# pre-tokenized copy of TRAIN_FILE (see token_cache.py)
+TOKEN_CACHE_PATH = os.path.join(os.path.abspath(
+    os.path.dirname(__file__)), "../data/cache/tokens/train")
 MODEL_NAME = "t5-small"
+# a tokenizer trained with domain_tokenizer.py (the model is resized to it), by default the stock t5 one
+TOKENIZER_PATH = os.environ.get("FIG2NAME_TOKENIZER")
+MODEL_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), "../data/models/")
 
 # Dataset
 
 
 class FigmaDataset(Dataset):
-    def __init__(self, file_path, tokenizer, max_input_length=128, max_target_length=64):
-        with open(file_path, 'r') as f:
-            self.data = json.load(f)
+    """
+    Records of `file_path`, tokenized once into a memory-mapped cache at `cache_path`
+    (rebuilt when the records, the tokenizer or `process_record` change; with build_cache=False it must already be up to date).
+    Items are unpadded (input ids, target ids); `pad_collate` pads each batch to its longest sequences.
+    """
+
+    def __init__(self, file_path, tokenizer, max_input_length=128, max_target_length=64, cache_path=TOKEN_CACHE_PATH,
+                 build_cache=True):
         self.tokenizer = tokenizer
         self.max_input_length = max_input_length
         self.max_target_length = max_target_length
+        manifest = open_token_cache(
+            cache_path, file_path, tokenizer, self.process_record, max_input_length, max_target_length, build=build_cache)
+        self.tokens = TokenCache(cache_path, manifest["count"])
 
     def __len__(self):
-        return len(self.data)
+        return len(self.tokens)
 
     def __getitem__(self, idx):
-        record = self.data[idx]
-        input_features = self.process_record(record)
-        input_ids = self.tokenizer.encode(
-            input_features, max_length=self.max_input_length, truncation=True, padding="max_length", return_tensors="pt")
-        target_ids = self.tokenizer.encode(
-            record['name_t'], max_length=self.max_target_length, truncation=True, padding="max_length", return_tensors="pt")
-        return input_ids.squeeze(), target_ids.squeeze()
-
-    @staticmethod
-    def process_record(record):
-
-        el_str = f"EL: {record['el']} "
-        value_str = f"VALUE: {record['value']} " if record.get('value') else ""
-        input_features = f"{el_str}{value_str}"
-
-        # Preprocess the record into a suitable format for the model
-        # This should include tokenization, one-hot encoding, and other necessary conversions
-        # type_str = f"TYPE: {record['type']} "
-        # color_str = f"COLOR: {record['color']} " if record['color'] else ""
-        # background_str = f"BACKGROUND: {record['background']} " if record['background'] else ""
-        # text_str = f"TEXT: {record['text']} " if record.get('text') else ""
-        # child_count = len(record['children']) if record.get('children') else 0
-        # children_str = f"CHILD_COUNT: {child_count} "
-        # input_features = f"{type_str}{color_str}{background_str}{text_str}{children_str}"
-        return input_features
-
-# Model
-
-
-class FigmaLayerRenamer(pl.LightningModule):
-    def __init__(self, model_name):
-        super().__init__()
-        self.seq2seq = AutoModelForSeq2SeqLM.from_pretrained(model_name)
-
-    def forward(self, input_ids, target_ids=None):
-        if target_ids is not None:
-            outputs = self.seq2seq(input_ids=input_ids, labels=target_ids)
-            return outputs.loss
-        else:
-            predicted_ids = self.seq2seq.generate(input_ids=input_ids)
-            return predicted_ids
-
-    def training_step(self, batch, batch_idx):
-        input_ids, target_ids = batch
-        loss = self(input_ids, target_ids)
-        self.log("train_loss", loss)
-        return loss
-
-    def configure_optimizers(self):
-        optimizer = torch.optim.Adam(self.parameters(), lr=5e-5)
-        return optimizer
-
-
-# DataModule
-class FigmaDataModule(pl.LightningDataModule):
-    def __init__(self, train_file, tokenizer, batch_size=8):
-        super().__init__()
-        self.train_file = train_file
+        input_ids, target_ids = self.tokens[idx]
+        return torch.from_numpy(input_ids.astype(np.int64)), torch.from_numpy(target_ids.astype(np.int64))
+
+    process_record = staticmethod(format_record)
+
+
+def pad_collate(batch, pad_token_id=0):
+    """
+    Pad a batch of (input ids, target ids) to its longest input and target: (input ids, attention mask, labels),
+    with padded label positions set to -100 so they are left out of the loss.
+    """
+    inputs, targets = zip(*batch)
+    input_ids = pad_sequence(inputs, batch_first=True, padding_value=pad_token_id)
+    attention_mask = pad_sequence([torch.ones_like(ids) for ids in inputs], batch_first=True, padding_value=0)
+    labels = pad_sequence(targets, batch_first=True, padding_value=-100)
+    return input_ids, attention_mask, labels
+
+
+class StreamingFigmaDataset(IterableDataset):
+    """
+    Records streamed from sharded JSONL (see jsonl_shards.py), tokenized on the fly: nothing is loaded up front,
+    so training starts right away and memory does not grow with the corpus.
+    Shards are split between the DataLoader workers of every rank; with fewer shards than readers, every reader
+    goes through all of them and keeps every n-th record. For DDP, use equally sized shards, a multiple of
+    world size * num_workers of them, so every rank sees the same number of batches.
+    Records are shuffled within a `shuffle_buffer` window (and the shard order per epoch).
+    """
+
+    def __init__(self, path, tokenizer, max_input_length=128, max_target_length=64, shuffle_buffer=10_000,
+                 seed=0, tokenize_chunk=512):
+        self.paths = shard_paths(path)
         self.tokenizer = tokenizer
-        self.batch_size = batch_size
-
-    def setup(self, stage=None):
-        self.train_dataset = FigmaDataset(self.train_file, self.tokenizer)
-
-    def train_dataloader(self):
-        return DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True)
-
-
-# Load data
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-data_module = FigmaDataModule(TRAIN_FILE, tokenizer)
-
-# Model setup
-model = FigmaLayerRenamer(MODEL_NAME)
-
-# Training with progress bar
-progress_bar = TQDMProgressBar()
-trainer = pl.Trainer(max_epochs=10, callbacks=[progress_bar])
-trainer.fit(model, data_module)
-
-MODEL_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), "../data/models/")
-
-# Save the trained model
-model.seq2seq.save_pretrained(MODEL_PATH)
-
-tokenizer.save_pretrained(MODEL_PATH)
\ No newline at end of file
+        self.max_input_length = max_input_length
+        self.max_target_length = max_target_length
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.tokenize_chunk = tokenize_chunk
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def reader(self):
+        """
+        (index of this reader, number of readers) over all the workers of all the ranks.
+        """
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def records(self, rng):
+        index, readers = self.reader()
+        if len(self.paths) >= readers:
+            paths = self.paths[index::readers]
+            rng.shuffle(paths)
+            return iter_records(paths)
+        return iter_records(self.paths, skip=index, step=readers)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        # the DataLoader seeds workers differently every epoch; without workers the epoch counter changes the order
+        rng = random.Random(hash((self.seed, self.epoch, worker.seed if worker is not None else 0)))
+        self.epoch += 1
+
+        records = shuffled(self.records(rng), self.shuffle_buffer, rng)
+        while True:
+            chunk = list(islice(records, self.tokenize_chunk))
+            if not chunk:
+                return
+            inputs = self.tokenizer([FigmaDataset.process_record(record) for record in chunk],
+                                    max_length=self.max_input_length, truncation=True)["input_ids"]
+            targets = self.tokenizer([record['name_t'] for record in chunk],
+                                     max_length=self.max_target_length, truncation=True)["input_ids"]
+            for input_ids, target_ids in zip(inputs, targets):
+                yield torch.tensor(input_ids), torch.tensor(target_ids)
+
+
+def __getattr__(name):
+    # the Lightning classes pull in pytorch_lightning and transformers, only load them when used
+    if name in ("FigmaLayerRenamer", "FigmaDataModule"):
+        import lightning_modules
+        return getattr(lightning_modules, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def train(train_file=TRAIN_FILE, tokenizer_path=TOKENIZER_PATH, model_path=MODEL_PATH, epochs=10, batch_size=8, num_workers=0):
+    """
+    Fine-tune MODEL_NAME on `train_file` and save the model and tokenizer to `model_path`.
+    """
+    from transformers import AutoTokenizer
+    import pytorch_lightning as pl
+    from pytorch_lightning.callbacks import TQDMProgressBar
+    from lightning_modules import FigmaLayerRenamer, FigmaDataModule
+
+    # Load data
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path or MODEL_NAME)
+    data_module = FigmaDataModule(train_file, tokenizer, batch_size, num_workers)
+
+    # Model setup
+    model = FigmaLayerRenamer(MODEL_NAME)
+    if tokenizer_path:
+        from domain_tokenizer import resize_embeddings
+        resize_embeddings(model.seq2seq, AutoTokenizer.from_pretrained(MODEL_NAME), tokenizer)
+
+    # Training with progress bar
+    progress_bar = TQDMProgressBar()
+    trainer = pl.Trainer(max_epochs=epochs, callbacks=[progress_bar])
+    trainer.fit(model, data_module)
+
+    # Save the trained model
+    model.seq2seq.save_pretrained(model_path)
+
+    tokenizer.save_pretrained(model_path)
+    return model_path
+
+
+if __name__ == "__main__":
+    train()